@@ -1,31 +1,39 @@
+import argparse
 import asyncio
-from dig_server.db import database_proxy, Task, initialize_db
-from dig_server.server import get_db, lifespan
+import datetime
 
+import httpx
 
-def get_db():
-    db = database_proxy.obj
-    db.connect(reuse_if_open=True)
-    try:
-        yield db
-    finally:
-        if not db.is_closed():
-            db.close()
+from dig_server.server import backend, lifespan
 
 
-async def main():
+def print_stats(stats):
+    counts = stats["counts"]
+    print(counts["pending"], counts["completed"], counts["processing"])
+    print(f"Progress: {stats['progress']*100:.2f}%")
+    for window, rate in stats["throughput"].items():
+        print(f"Throughput ({window}): {rate:.2f} images/s")
+    if stats["eta_seconds"] is not None:
+        print(f"ETA: {datetime.timedelta(seconds=int(stats['eta_seconds']))}")
+
+
+async def main(url=None):
+    if url:
+        async with httpx.AsyncClient() as client:
+            response = await client.get(f"{url}/stats")
+            response.raise_for_status()
+            print_stats(response.json())
+        return
+    # Goes through the configured backend, so sharded and in-memory queues
+    # work too
     async with lifespan(app=None):
-        for db in get_db():
-            with db.atomic():
-                finished_tasks = Task.select().where(Task.status == "completed")
-                waiting_tasks = Task.select().where(Task.status == "pending")
-                processing_tasks = Task.select().where(Task.status == "processing")
-                print(len(waiting_tasks), len(finished_tasks), len(processing_tasks))
-                progress = len(finished_tasks) / (
-                    len(waiting_tasks) + len(processing_tasks) + len(finished_tasks)
-                )
-                print(f"Progress: {progress*100:.2f}%")
+        print_stats(await backend.queue_stats())
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--url", default=None, help="Query a running server instead of DB_PATH"
+    )
+    args = parser.parse_args()
+    asyncio.run(main(args.url))
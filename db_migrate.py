@@ -1,6 +1,6 @@
 import asyncio
 from dig_server.db import database_proxy, Task, initialize_db
-from dig_server.server import get_db, lifespan
+from dig_server.server import lifespan
 from tqdm import tqdm
 
 
@@ -29,10 +29,17 @@ async def main():
                         task.image_path = f"images/{task.task_id}.webp"
                     task.save()
             with db.atomic():
-                for task in tqdm(Task.select().where(Task.status == "processing")):
-                    task.status = "pending"
-                    task.image_path = task.image_path = None
-                    task.save()
+                reset = (
+                    Task.update(
+                        status="pending",
+                        image_path=None,
+                        worker_id=None,
+                        lease_expires_at=None,
+                    )
+                    .where(Task.status == "processing")
+                    .execute()
+                )
+                print(f"Reset {reset} processing tasks")
 
 
 if __name__ == "__main__":
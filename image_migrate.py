@@ -0,0 +1,116 @@
+import io
+import os
+import sqlite3
+import argparse
+import asyncio
+
+from tqdm import tqdm
+
+from dig_server.server import backend, image_store, lifespan
+
+
+def open_journal(path):
+    # Old -> new location of every moved image, kept on disk so a stopped run
+    # resumes without copying shared images twice and still cleans up after
+    # the rows it moved before
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    journal = sqlite3.connect(path)
+    journal.execute(
+        "CREATE TABLE IF NOT EXISTS moved (old TEXT PRIMARY KEY, new TEXT NOT NULL)"
+    )
+    return journal
+
+
+def move_image(location):
+    # Copies one image into the configured store, returns its new location
+    image = image_store.read(location)
+    if image is None:
+        return None
+    data, _ = image
+    return image_store.save(image_store.key(location), io.BytesIO(bytes(data)))
+
+
+def moved_locations(journal, locations):
+    rows = journal.execute(
+        f"SELECT old, new FROM moved WHERE old IN ({','.join('?' * len(locations))})",
+        list(locations),
+    )
+    return dict(rows)
+
+
+async def move_all(journal, page_size):
+    # Pages through the completed tasks by task id and moves every image that
+    # isn't in the IMAGE_STORE layout yet, one page of rows at a time. Tasks
+    # linked to the same image keep sharing its new copy.
+    moved = missing = 0
+    after = None
+    progress = tqdm(unit="task")
+    while True:
+        images = await backend.completed_images(after=after, limit=page_size)
+        if not images:
+            break
+        after = images[-1][0]
+        pending = {location for _, location in images if not image_store.owns(location)}
+        known = moved_locations(journal, pending) if pending else {}
+        for location in pending - known.keys():
+            new_location = await asyncio.to_thread(move_image, location)
+            if new_location is None:
+                missing += 1
+                continue
+            known[location] = new_location
+            moved += 1
+        # The copies are recorded before any row points at them
+        journal.executemany("INSERT OR REPLACE INTO moved VALUES (?, ?)", known.items())
+        journal.commit()
+        paths = {
+            task_id: known[location]
+            for task_id, location in images
+            if location in known
+        }
+        if paths:
+            await backend.set_image_paths(paths)
+        progress.update(len(images))
+    progress.close()
+    print(f"Moved {moved} images, {missing} missing")
+
+
+def sweep(journal):
+    # Every row has been moved once move_all finished, so no row points at
+    # the old files anymore. Old packs are left in place.
+    removed = 0
+    for (old,) in journal.execute("SELECT old FROM moved"):
+        path = image_store.local_path(old)
+        if path is not None and os.path.exists(path):
+            os.remove(path)
+            removed += 1
+    print(f"Removed {removed} old files")
+
+
+async def main(args):
+    # Run with the server stopped
+    journal = open_journal(args.journal)
+    try:
+        async with lifespan(app=None):
+            await move_all(journal, args.page_size)
+        if not args.keep:
+            sweep(journal)
+    finally:
+        journal.close()
+    if not args.keep:
+        os.remove(args.journal)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Move completed images into the IMAGE_STORE layout"
+    )
+    parser.add_argument("--page-size", type=int, default=1000)
+    parser.add_argument(
+        "--journal",
+        default="db/image_migrate.db",
+        help="Moved locations, removed after a complete run",
+    )
+    parser.add_argument(
+        "--keep", action="store_true", help="Leave the old image files in place"
+    )
+    asyncio.run(main(parser.parse_args()))
@@ -8,7 +8,7 @@ from kgen.formatter import seperate_tags, apply_format
 import dig_client.config as config
 
 config.SERVER_URL = "http://192.168.1.2:21224"
-from dig_client.requestor import request_image_generation, cleanup
+from dig_client.requestor import build_request, request_image_generation_bulk, cleanup
 
 
 DEFAULT_FORMAT = """<|special|>,
@@ -17,7 +17,6 @@ DEFAULT_FORMAT = """<|special|>,
 <|general|>,
 <|quality|>, <|meta|>, <|rating|>
 """
-BATCH_SIZE = 100
 ALL_POSTFIX = ["", "oai", "promptist", "gpt2"]
 ALL_CATE = ["coyo", "gbc"]
 ALL_SHORT_KEY = ["caption_llava_short", "short_caption"]
@@ -48,56 +47,35 @@ def load_prompts(file):
 async def main_gbc_coyo():
     global client
     datas = load_prompts(f"./data/{CATE}-output.jsonl")
-    tasks = []
+    requests = []
     for entry in datas:
         index, org_prompt1, org_prompt2, gen_prompt1, gen_prompt2 = entry
-        tasks.append(
-            request_image_generation(org_prompt1, f"{CATE}-{index}-short", int(index))
+        requests.append(build_request(org_prompt1, f"{CATE}-{index}-short", int(index)))
+        requests.append(build_request(org_prompt2, f"{CATE}-{index}-tlong", int(index)))
+        requests.append(
+            build_request(gen_prompt1, f"{CATE}-{index}-tipo-short", int(index))
         )
-        tasks.append(
-            request_image_generation(org_prompt2, f"{CATE}-{index}-tlong", int(index))
+        requests.append(
+            build_request(gen_prompt2, f"{CATE}-{index}-tipo-tlong", int(index))
         )
-        tasks.append(
-            request_image_generation(
-                gen_prompt1, f"{CATE}-{index}-tipo-short", int(index)
-            )
-        )
-        tasks.append(
-            request_image_generation(
-                gen_prompt2, f"{CATE}-{index}-tipo-tlong", int(index)
-            )
-        )
-    for batch in tqdm(
-        [tasks[i : i + BATCH_SIZE] for i in range(0, len(tasks), BATCH_SIZE)],
-        total=len(tasks) // BATCH_SIZE + int(bool(len(tasks) % BATCH_SIZE)),
-        desc="Requesting images",
-    ):
-        await asyncio.gather(*batch)
+    task_ids = await request_image_generation_bulk(requests)
+    print(f"Requested {len(task_ids)}/{len(requests)} images")
 
 
 async def main_gbc_coyo_other():
     global client
     datas = load_prompts(f"./data/{CATE}-output-{POSTFIX}.jsonl")
-    tasks = []
+    requests = []
     for entry in datas:
         index, org_prompt1, org_prompt2, gen_prompt1, gen_prompt2 = entry
-        tasks.append(
-            request_image_generation(
-                gen_prompt1, f"{CATE}-{index}-{POSTFIX}-short", int(index)
-            )
+        requests.append(
+            build_request(gen_prompt1, f"{CATE}-{index}-{POSTFIX}-short", int(index))
         )
-        tasks.append(
-            request_image_generation(
-                gen_prompt2, f"{CATE}-{index}-{POSTFIX}-tlong", int(index)
-            )
+        requests.append(
+            build_request(gen_prompt2, f"{CATE}-{index}-{POSTFIX}-tlong", int(index))
         )
-    for batch in tqdm(
-        [tasks[i : i + BATCH_SIZE] for i in range(0, len(tasks), BATCH_SIZE)],
-        total=len(tasks) // BATCH_SIZE + int(bool(len(tasks) % BATCH_SIZE)),
-        desc="Requesting images",
-        leave=False,
-    ):
-        await asyncio.gather(*batch)
+    task_ids = await request_image_generation_bulk(requests)
+    print(f"Requested {len(task_ids)}/{len(requests)} images")
 
 
 def load_prompts_dan_scenery(file):
@@ -120,24 +98,17 @@ def load_prompts_dan_scenery(file):
 async def main_dan_scenery():
     global client
     datas = load_prompts_dan_scenery("./data/scenery-output-promptist.jsonl")
-    tasks = []
+    requests = []
     for entry in datas:
         index, org_prompt1, gen_prompt1 = entry
-        # tasks.append(
-        #     request_image_generation(org_prompt1, f"dan-scenery-{index}", int(index))
+        # requests.append(
+        #     build_request(org_prompt1, f"dan-scenery-{index}", int(index))
         # )
-        tasks.append(
-            request_image_generation(
-                gen_prompt1, f"dan-scenery-{index}-promptist", int(index)
-            )
+        requests.append(
+            build_request(gen_prompt1, f"dan-scenery-{index}-promptist", int(index))
         )
-    for batch in tqdm(
-        [tasks[i : i + 100] for i in range(0, len(tasks), 100)],
-        total=len(tasks) // 100,
-        desc="Requesting images",
-        leave=False,
-    ):
-        await asyncio.gather(*batch)
+    task_ids = await request_image_generation_bulk(requests)
+    print(f"Requested {len(task_ids)}/{len(requests)} images")
 
 
 async def main():
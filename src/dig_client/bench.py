@@ -0,0 +1,392 @@
+import os
+import gc
+import json
+import ctypes
+import string
+import argparse
+import resource
+import tempfile
+import threading
+from time import perf_counter
+
+import torch
+from diffusers import (
+    StableDiffusionXLKDiffusionPipeline,
+    UNet2DConditionModel,
+    AutoencoderKL,
+    EulerDiscreteScheduler,
+)
+from transformers import (
+    CLIPTokenizer,
+    CLIPTextConfig,
+    CLIPTextModel,
+    CLIPTextModelWithProjection,
+)
+
+from .diff import (
+    load_model,
+    setup_sampling,
+    encode_prompts,
+    generate,
+    decode_latents,
+    tokenize,
+)
+
+# What identifies a point when comparing against a baseline report
+POINT_FIELDS = ("batch_size", "resolution", "prompt_tokens", "steps", "sampler")
+
+PROMPT_WORDS = [
+    "masterpiece",
+    "1girl",
+    "solo",
+    "outdoors",
+    "sky",
+    "cloud",
+    "smile",
+    "long hair",
+    "blue eyes",
+    "dress",
+]
+
+
+def tiny_tokenizer(directory: str):
+    # Character level CLIP tokenizer, no merges, so it needs no downloads
+    chars = string.ascii_lowercase + string.digits + ",.() "
+    vocab = {}
+    for char in chars:
+        vocab[char] = len(vocab)
+    for char in chars:
+        vocab[f"{char}</w>"] = len(vocab)
+    vocab["<|startoftext|>"] = len(vocab)
+    vocab["<|endoftext|>"] = len(vocab)
+    with open(os.path.join(directory, "vocab.json"), "w", encoding="utf-8") as f:
+        json.dump(vocab, f)
+    with open(os.path.join(directory, "merges.txt"), "w", encoding="utf-8") as f:
+        f.write("#version: 0.2\n")
+    return CLIPTokenizer(
+        os.path.join(directory, "vocab.json"),
+        os.path.join(directory, "merges.txt"),
+        pad_token="<|endoftext|>",
+        model_max_length=77,
+    )
+
+
+def tiny_pipeline(seed=0) -> StableDiffusionXLKDiffusionPipeline:
+    # Randomly initialized, SDXL shaped (two text encoders, text_time added
+    # conditioning, 8x VAE) but small enough to run every phase on a CPU.
+    torch.manual_seed(seed)
+    tokenizer = tiny_tokenizer(tempfile.mkdtemp())
+    vocab_size = len(tokenizer.get_vocab())
+    text_config = dict(
+        vocab_size=vocab_size,
+        hidden_size=32,
+        intermediate_size=37,
+        num_attention_heads=4,
+        num_hidden_layers=3,
+        max_position_embeddings=77,
+        projection_dim=32,
+        bos_token_id=vocab_size - 2,
+        eos_token_id=vocab_size - 1,
+        pad_token_id=vocab_size - 1,
+    )
+    unet = UNet2DConditionModel(
+        sample_size=32,
+        in_channels=4,
+        out_channels=4,
+        block_out_channels=(32, 64),
+        layers_per_block=1,
+        down_block_types=("DownBlock2D", "CrossAttnDownBlock2D"),
+        up_block_types=("CrossAttnUpBlock2D", "UpBlock2D"),
+        attention_head_dim=(2, 4),
+        transformer_layers_per_block=(1, 1),
+        use_linear_projection=True,
+        cross_attention_dim=64,
+        addition_embed_type="text_time",
+        addition_time_embed_dim=8,
+        projection_class_embeddings_input_dim=32 + 6 * 8,
+        norm_num_groups=8,
+    )
+    vae = AutoencoderKL(
+        in_channels=3,
+        out_channels=3,
+        block_out_channels=(8, 8, 16, 16),
+        down_block_types=("DownEncoderBlock2D",) * 4,
+        up_block_types=("UpDecoderBlock2D",) * 4,
+        latent_channels=4,
+        norm_num_groups=8,
+        sample_size=256,
+    )
+    scheduler = EulerDiscreteScheduler(
+        beta_start=0.00085,
+        beta_end=0.012,
+        beta_schedule="scaled_linear",
+        steps_offset=1,
+        timestep_spacing="leading",
+    )
+    pipe = StableDiffusionXLKDiffusionPipeline(
+        vae=vae,
+        text_encoder=CLIPTextModel(CLIPTextConfig(**text_config)),
+        text_encoder_2=CLIPTextModelWithProjection(CLIPTextConfig(**text_config)),
+        tokenizer=tokenizer,
+        tokenizer_2=tokenizer,
+        unet=unet,
+        scheduler=scheduler,
+    )
+    setup_sampling(pipe)
+    return pipe
+
+
+def make_prompt(pipe: StableDiffusionXLKDiffusionPipeline, tokens: int) -> str:
+    # Comma separated tags until the prompt is `tokens` tokens long
+    words = []
+    while True:
+        words.append(PROMPT_WORDS[len(words) % len(PROMPT_WORDS)])
+        prompt = ", ".join(words)
+        if len(tokenize(pipe, [prompt])[0][0]) >= tokens:
+            return prompt
+
+
+def sync(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def current_rss_mb():
+    # Resident set size right now, None where /proc isn't available
+    try:
+        with open("/proc/self/statm", "r") as f:
+            pages = int(f.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return pages * os.sysconf("SC_PAGE_SIZE") / 1024**2
+
+
+def release_memory():
+    # Hand freed heap back to the OS, so the next point starts from a low RSS
+    gc.collect()
+    try:
+        ctypes.CDLL("libc.so.6").malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+
+class RssSampler:
+    # Highest RSS seen while the block runs, polled from a thread since the
+    # CPU has no allocator peak counter to reset like CUDA
+    def __init__(self, interval=0.002):
+        self.interval = interval
+        self.peak = None
+        self.stop = threading.Event()
+
+    def sample(self):
+        rss = current_rss_mb()
+        if rss is not None:
+            self.peak = rss if self.peak is None else max(self.peak, rss)
+
+    def poll(self):
+        while not self.stop.wait(self.interval):
+            self.sample()
+
+    def __enter__(self):
+        self.sample()
+        self.thread = threading.Thread(target=self.poll, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop.set()
+        self.thread.join()
+        self.sample()
+
+
+def peak_memory_mb(device, sampler=None):
+    # Allocator peak on CUDA, sampled RSS peak of this point on CPU. Without
+    # /proc only the process high-water mark is left, which never resets.
+    if device.type == "cuda":
+        return torch.cuda.max_memory_allocated(device) / 1024**2
+    if sampler is not None and sampler.peak is not None:
+        return sampler.peak
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_once(pipe, prompts, width, height, steps, sampler):
+    device = pipe.device
+    phases = {}
+    t0 = perf_counter()
+    # Padded to whole text encoder chunks like the worker's length buckets,
+    # so longer prompts cost what they cost there
+    (embeds, neg_embeds), (pooled, neg_pooled) = encode_prompts(
+        pipe, prompts, "", cutoff_length=None, take_all_eos=True
+    )
+    sync(device)
+    t1 = perf_counter()
+    latents = generate(
+        pipe,
+        embeds,
+        neg_embeds,
+        pooled,
+        neg_pooled,
+        num_inference_steps=steps,
+        width=width,
+        height=height,
+        seeds=list(range(len(prompts))),
+        sampler=sampler,
+        output_type="latent",
+    )
+    sync(device)
+    t2 = perf_counter()
+    decode_latents(pipe, latents)
+    sync(device)
+    t3 = perf_counter()
+    phases["encode"] = t1 - t0
+    phases["sample"] = t2 - t1
+    phases["decode"] = t3 - t2
+    return phases
+
+
+def bench(
+    pipe,
+    batch_sizes,
+    resolutions,
+    prompt_lengths,
+    steps=4,
+    sampler="euler",
+    repeats=3,
+):
+    results = []
+    for tokens in prompt_lengths:
+        prompt = make_prompt(pipe, tokens)
+        for resolution in resolutions:
+            for batch_size in batch_sizes:
+                prompts = [prompt] * batch_size
+                # Warmup, kernels and allocator caches
+                run_once(pipe, prompts, resolution, resolution, steps, sampler)
+                if pipe.device.type == "cuda":
+                    torch.cuda.reset_peak_memory_stats(pipe.device)
+                else:
+                    release_memory()
+                with RssSampler() as rss:
+                    runs = [
+                        run_once(pipe, prompts, resolution, resolution, steps, sampler)
+                        for _ in range(repeats)
+                    ]
+                phases = {phase: min(run[phase] for run in runs) for phase in runs[0]}
+                total = sum(phases.values())
+                results.append(
+                    {
+                        "batch_size": batch_size,
+                        "resolution": resolution,
+                        "prompt_tokens": tokens,
+                        "steps": steps,
+                        "sampler": sampler,
+                        "phases_s": phases,
+                        "total_s": total,
+                        "images_per_s": batch_size / total,
+                        "peak_memory_mb": peak_memory_mb(pipe.device, rss),
+                    }
+                )
+                print(
+                    f"bs={batch_size} res={resolution} tokens={tokens}: "
+                    + ", ".join(f"{k} {v*1000:.1f}ms" for k, v in phases.items())
+                    + f", {batch_size / total:.2f} images/s"
+                )
+    return results
+
+
+def point_key(result):
+    return tuple(result[field] for field in POINT_FIELDS)
+
+
+def compare(results, baseline, tolerance=0.2):
+    # Phases of points also in the baseline report that got more than
+    # `tolerance` slower
+    previous = {point_key(result): result for result in baseline["results"]}
+    regressions = []
+    for result in results:
+        old = previous.get(point_key(result))
+        if old is None:
+            continue
+        for phase, seconds in result["phases_s"].items():
+            old_seconds = old["phases_s"].get(phase)
+            if old_seconds and seconds > old_seconds * (1 + tolerance):
+                regressions.append(
+                    {
+                        "point": dict(zip(POINT_FIELDS, point_key(result))),
+                        "phase": phase,
+                        "baseline_s": old_seconds,
+                        "current_s": seconds,
+                    }
+                )
+    return regressions
+
+
+def int_list(value: str):
+    return [int(v) for v in value.split(",")]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Time encode_prompts, sampling and VAE decode separately"
+    )
+    parser.add_argument(
+        "--model",
+        default=None,
+        help="Model to load with load_model, the tiny random pipeline if omitted",
+    )
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--batch-sizes", type=int_list, default=[1, 2])
+    parser.add_argument("--resolutions", type=int_list, default=[64, 128])
+    parser.add_argument("--prompt-lengths", type=int_list, default=[20, 150])
+    parser.add_argument("--steps", type=int, default=4)
+    parser.add_argument("--sampler", default="euler")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--output", default=None, help="Write the results as JSON")
+    parser.add_argument(
+        "--baseline",
+        default=None,
+        help="A previous --output report, exits with 1 if a phase got slower",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="Slowdown over the baseline allowed per phase, 0.2 is 20%%",
+    )
+    args = parser.parse_args()
+
+    torch.set_grad_enabled(False)
+    if args.model:
+        pipe = load_model(args.model, device=args.device, custom_vae=True)
+    else:
+        pipe = tiny_pipeline().to(args.device)
+    results = bench(
+        pipe,
+        args.batch_sizes,
+        args.resolutions,
+        args.prompt_lengths,
+        args.steps,
+        args.sampler,
+        args.repeats,
+    )
+    report = {
+        "model": args.model or "tiny",
+        "device": args.device,
+        "torch": torch.__version__,
+        "results": results,
+    }
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            report["regressions"] = compare(results, json.load(f), args.tolerance)
+        for regression in report["regressions"]:
+            print(
+                f"Regression in {regression['phase']} at {regression['point']}: "
+                f"{regression['baseline_s'] * 1000:.1f}ms -> "
+                f"{regression['current_s'] * 1000:.1f}ms"
+            )
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    if report.get("regressions"):
+        raise SystemExit(1)
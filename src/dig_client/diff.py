@@ -4,17 +4,16 @@ from functools import partial
 from time import time
 from PIL import Image
 
-import numpy as np
 import torch
 from diffusers import (
     StableDiffusionXLKDiffusionPipeline,
     UNet2DConditionModel,
     AutoencoderKL,
 )
-from transformers import set_seed
 from k_diffusion.external import CompVisDenoiser
 from k_diffusion.sampling import get_sigmas_polyexponential
 from k_diffusion.sampling import (
+    sample_dpmpp_2m,
     sample_dpmpp_2m_sde,
     sample_euler,
     sample_euler_ancestral,
@@ -46,12 +45,40 @@ def set_timesteps_exponential(self, orig_sigmas, num_inference_steps, device=Non
 
 def set_timesteps_linear(self, orig_sigmas, num_inference_steps, device=None):
     self.num_inference_steps = num_inference_steps
+    # The last training sigma is the trailing 0, don't pick it twice
     index = (
-        torch.linspace(0, orig_sigmas.numel() - 1, num_inference_steps).round().long()
+        torch.linspace(0, orig_sigmas.numel() - 2, num_inference_steps).round().long()
     )
     self.sigmas = torch.cat([orig_sigmas[index], self.sigmas.new_zeros([1])])
 
 
+# Samplers and step schedules selectable per task through extra_args. The
+# server validates requests against these names, keep them in sync with
+# dig_server.server.SAMPLERS and SCHEDULES.
+SAMPLERS = {
+    "euler": sample_euler,
+    "euler_ancestral": sample_euler_ancestral,
+    "dpmpp_2m": sample_dpmpp_2m,
+    "dpmpp_2m_sde": partial(sample_dpmpp_2m_sde, eta=0.35, solver_type="heun"),
+}
+# Samplers which inject fresh noise every step and take a noise_sampler
+STOCHASTIC_SAMPLERS = {"euler_ancestral", "dpmpp_2m_sde"}
+SCHEDULES = {
+    "exponential": set_timesteps_exponential,
+    "polyexponential": set_timesteps_polyexponential,
+    "linear": set_timesteps_linear,
+}
+
+
+def setup_sampling(pipe: StableDiffusionXLKDiffusionPipeline):
+    # Keep the training sigmas around, every schedule is derived from them
+    pipe.orig_sigmas = pipe.scheduler.sigmas
+    pipe.scheduler.set_timesteps = partial(
+        set_timesteps_exponential, pipe.scheduler, pipe.orig_sigmas
+    )
+    pipe.sampler = SAMPLERS["dpmpp_2m_sde"]
+
+
 def model_forward(k_diffusion_model: torch.nn.Module):
     orig_forward = k_diffusion_model.forward
 
@@ -85,66 +112,75 @@ def load_model(model_id="KBlueLeaf/Kohaku-XL-Zeta", device="cuda", custom_vae=Fa
     unet: UNet2DConditionModel = pipe.k_diffusion_model.inner_model.model
     unet.eval().half()
     unet.enable_xformers_memory_efficient_attention()
-    pipe.scheduler.set_timesteps = partial(
-        set_timesteps_exponential, pipe.scheduler, pipe.scheduler.sigmas
-    )
-    # pipe.scheduler.set_timesteps = partial(
-    #     set_timesteps_linear, pipe.scheduler, pipe.scheduler.sigmas
-    # )
-    pipe.sampler = partial(sample_dpmpp_2m_sde, eta=0.35, solver_type="heun")
+    setup_sampling(pipe)
     pipe.k_diffusion_model.forward = model_forward(pipe.k_diffusion_model)
     return pipe
 
 
-@torch.no_grad()
-def encode_prompts(
+def tokenize(pipe: StableDiffusionXLKDiffusionPipeline, prompts: list[str]):
+    # One pass per tokenizer, without special tokens, padding or truncation.
+    # Lengths, bucketing and padding are all derived from these ids.
+    return (
+        pipe.tokenizer(prompts, add_special_tokens=False, verbose=False).input_ids,
+        pipe.tokenizer_2(prompts, add_special_tokens=False, verbose=False).input_ids,
+    )
+
+
+def pad_tokens(tokenizer, tokens: list[list[int]], target_length: int):
+    # Same ids as tokenizer(..., padding="max_length", truncation=True)
+    rows = []
+    for ids in tokens:
+        ids = [
+            tokenizer.bos_token_id,
+            *ids[: target_length - 2],
+            tokenizer.eos_token_id,
+        ]
+        rows.append(ids + [tokenizer.pad_token_id] * (target_length - len(ids)))
+    return torch.tensor(rows)
+
+
+def token_length(tokens) -> int:
+    # Longest prompt in either tokenizer, special tokens included
+    return max(len(ids) for ids in tokens[0] + tokens[1]) + 2
+
+
+def chunk_count(pipe: StableDiffusionXLKDiffusionPipeline, length: int) -> int:
+    # Number of text encoder passes a prompt of `length` tokens needs
+    return math.ceil(length / (pipe.tokenizer.model_max_length - 2))
+
+
+def get_target_length(
     pipe: StableDiffusionXLKDiffusionPipeline,
-    prompt: str | list[str],
-    neg_prompt: str | list[str] = "",
+    prompts: list[str],
     cutoff_length: int | None = 225,
-    padding_to_max_length: bool = True,
-    take_all_eos: bool = False,
+    tokens=None,
 ):
-    if not isinstance(prompt, list):
-        prompt = [prompt]
-    if not isinstance(neg_prompt, list):
-        neg_prompt = [neg_prompt]
-    if len(prompt) != len(neg_prompt) and (len(prompt) != 1 and len(neg_prompt) != 1):
-        raise ValueError("prompt and neg_prompt must have the same length")
-    if len(prompt) == 1:
-        prompt = prompt * len(neg_prompt)
-    if len(neg_prompt) == 1:
-        neg_prompt = neg_prompt * len(prompt)
-    prompts = prompt + neg_prompt
+    if cutoff_length:
+        return cutoff_length
     max_length = pipe.tokenizer.model_max_length - 2
+    tokens = tokens or tokenize(pipe, prompts)
+    return chunk_count(pipe, token_length(tokens)) * max_length + 2
 
-    input_ids = pipe.tokenizer(prompts, padding=True, return_tensors="pt")
-    input_ids2 = pipe.tokenizer_2(prompts, padding=True, return_tensors="pt")
-    input_ids_neg = pipe.tokenizer(neg_prompt, padding=True, return_tensors="pt")
-    length = max(input_ids.input_ids.size(-1), input_ids2.input_ids.size(-1))
-    neg_length = input_ids_neg.input_ids.size(-1)
-    target_length = cutoff_length or math.ceil(length / max_length) * max_length + 2
-    neg_groups = math.ceil(neg_length / max_length)
 
-    input_ids = pipe.tokenizer(
-        prompts,
-        padding="max_length",
-        max_length=target_length,
-        truncation=True,
-        return_tensors="pt",
-    ).input_ids
+@torch.no_grad()
+def encode_texts(
+    pipe: StableDiffusionXLKDiffusionPipeline,
+    prompts: list[str],
+    target_length: int,
+    take_all_eos: bool = False,
+    tokens=None,
+):
+    # Every row is encoded on its own, chunk by chunk, so the result for a text
+    # only depends on the text and target_length, not on the rest of the batch.
+    max_length = pipe.tokenizer.model_max_length - 2
+    tokens = tokens or tokenize(pipe, prompts)
+    input_ids = pad_tokens(pipe.tokenizer, tokens[0], target_length)
     input_ids = (
         input_ids[:, 0:1],
         input_ids[:, 1:-1],
         input_ids[:, -1:],
     )
-    input_ids2 = pipe.tokenizer_2(
-        prompts,
-        padding="max_length",
-        max_length=target_length,
-        truncation=True,
-        return_tensors="pt",
-    ).input_ids
+    input_ids2 = pad_tokens(pipe.tokenizer_2, tokens[1], target_length)
     input_ids2 = (
         input_ids2[:, 0:1],
         input_ids2[:, 1:-1],
@@ -192,6 +228,39 @@ def encode_prompts(
     prompt_embeds = torch.cat([prompt_embeds, prompt_embeds2], dim=-1)
 
     pooled = torch.mean(torch.stack(pooled_embeds2, dim=0), dim=0)
+    return prompt_embeds, pooled, (concat_embeds, concat_embeds2, pooled_embeds2)
+
+
+@torch.no_grad()
+def encode_prompts(
+    pipe: StableDiffusionXLKDiffusionPipeline,
+    prompt: str | list[str],
+    neg_prompt: str | list[str] = "",
+    cutoff_length: int | None = 225,
+    padding_to_max_length: bool = True,
+    take_all_eos: bool = False,
+):
+    if not isinstance(prompt, list):
+        prompt = [prompt]
+    if not isinstance(neg_prompt, list):
+        neg_prompt = [neg_prompt]
+    if len(prompt) != len(neg_prompt) and (len(prompt) != 1 and len(neg_prompt) != 1):
+        raise ValueError("prompt and neg_prompt must have the same length")
+    if len(prompt) == 1:
+        prompt = prompt * len(neg_prompt)
+    if len(neg_prompt) == 1:
+        neg_prompt = neg_prompt * len(prompt)
+    prompts = prompt + neg_prompt
+    max_length = pipe.tokenizer.model_max_length - 2
+
+    tokens = tokenize(pipe, prompts)
+    target_length = get_target_length(pipe, prompts, cutoff_length, tokens)
+    neg_length = max(len(ids) for ids in tokens[0][len(prompt) :]) + 2
+    neg_groups = math.ceil(neg_length / max_length)
+
+    prompt_embeds, pooled, (concat_embeds, concat_embeds2, pooled_embeds2) = (
+        encode_texts(pipe, prompts, target_length, take_all_eos, tokens)
+    )
 
     embed, neg_embed = prompt_embeds.chunk(2)
     pooled, neg_pooled = pooled.chunk(2)
@@ -211,16 +280,89 @@ def encode_prompts(
     return (embed, neg_embed), (pooled, neg_pooled)
 
 
-def vae_image_postprocess(image_tensor: torch.Tensor) -> Image.Image:
-    image = Image.fromarray(
-        ((image_tensor * 0.5 + 0.5) * 255)
-        .cpu()
+def vae_images_to_uint8(image_tensors: torch.Tensor) -> torch.Tensor:
+    # Quantize on the device so only uint8 NHWC pixels go to the host
+    return (
+        ((image_tensors * 0.5 + 0.5) * 255)
         .clamp(0, 255)
-        .numpy()
-        .astype(np.uint8)
-        .transpose(1, 2, 0)
+        .to(torch.uint8)
+        .permute(0, 2, 3, 1)
+    )
+
+
+def vae_image_postprocess(image_tensor: torch.Tensor) -> Image.Image:
+    return Image.fromarray(
+        vae_images_to_uint8(image_tensor.unsqueeze(0))[0].cpu().numpy()
     )
-    return image
+
+
+@torch.no_grad()
+def decode_latents(
+    pipe: StableDiffusionXLKDiffusionPipeline,
+    latents: torch.Tensor,
+    batch_size: int = 4,
+    tiled: bool = False,
+) -> list[Image.Image]:
+    # Decode in micro-batches to bound VAE activation memory, tiled_decode
+    # bounds it further for large resolutions. Pixels stay on the device until
+    # the whole batch is quantized, then move to the host in one transfer.
+    latents = latents / pipe.vae.config.scaling_factor
+    decode = pipe.vae.tiled_decode if tiled else pipe.vae.decode
+    pixels = []
+    for chunk in latents.split(batch_size):
+        image_tensors = decode(chunk.to(pipe.vae.dtype)).sample
+        pixels.append(vae_images_to_uint8(image_tensors))
+    pixels = torch.cat(pixels).cpu().numpy()
+    return [Image.fromarray(pixel) for pixel in pixels]
+
+
+def seeded_generators(seeds: list[int]) -> list[torch.Generator]:
+    return [torch.Generator().manual_seed(seed % 2**32) for seed in seeds]
+
+
+def draw_noise(generators: list[torch.Generator], shape, device, dtype):
+    # Each sample draws from its own CPU generator, so its noise only depends on
+    # its seed, not on the batch it lands in, the device or the global RNG.
+    # Filled into one (pinned) host buffer and moved to the device at once.
+    noise = torch.empty(
+        (len(generators), *shape), pin_memory=torch.device(device).type == "cuda"
+    )
+    for i, generator in enumerate(generators):
+        torch.randn(shape, generator=generator, out=noise[i])
+    return noise.to(device=device, dtype=dtype, non_blocking=True)
+
+
+def make_noise(seeds: list[int], shape, device, dtype) -> torch.Tensor:
+    return draw_noise(seeded_generators(seeds), shape, device, dtype)
+
+
+def pair_contexts(cond: torch.Tensor, uncond: torch.Tensor):
+    # Stacks cond and uncond text contexts for one batched UNet call. When the
+    # lengths differ but both divide the longer one, the contexts are tiled,
+    # which leaves cross attention unchanged. Otherwise the shorter one is zero
+    # padded and masked out with an encoder attention mask.
+    uncond = uncond.expand(cond.size(0), -1, -1)
+    length, uncond_length = cond.size(1), uncond.size(1)
+    if length == uncond_length:
+        return torch.cat([cond, uncond]), None
+    longest = max(length, uncond_length)
+    if longest % length == 0 and longest % uncond_length == 0:
+        return (
+            torch.cat(
+                [
+                    cond.repeat(1, longest // length, 1),
+                    uncond.repeat(1, longest // uncond_length, 1),
+                ]
+            ),
+            None,
+        )
+    num = cond.size(0)
+    mask = cond.new_zeros(2 * num, longest)
+    mask[:num, :length] = 1
+    mask[num:, :uncond_length] = 1
+    cond = torch.nn.functional.pad(cond, (0, 0, 0, longest - length))
+    uncond = torch.nn.functional.pad(uncond, (0, 0, 0, longest - uncond_length))
+    return torch.cat([cond, uncond]), mask
 
 
 @torch.no_grad()
@@ -235,7 +377,23 @@ def generate(
     height=1024,
     guidance_scale=7.0,
     seeds=-1,
+    decode_batch_size=4,
+    tiled_decode=False,
+    sampler="euler",
+    schedule=None,
+    guidance_interval=(0.0, math.inf),
+    stats: dict | None = None,
+    output_type="pil",
 ):
+    # schedule=None keeps the pipe's own set_timesteps (exponential)
+    if sampler not in SAMPLERS:
+        raise ValueError(
+            f"Unknown sampler {sampler!r}, expected one of {list(SAMPLERS)}"
+        )
+    if schedule is not None and schedule not in SCHEDULES:
+        raise ValueError(
+            f"Unknown schedule {schedule!r}, expected one of {list(SCHEDULES)}"
+        )
     num_gen = prompt_embeds.size(0)
     if isinstance(seeds, int):
         if seeds == -1:
@@ -250,69 +408,74 @@ def generate(
         seeds = [seed if seed != -1 else randint(0, 2**32 - 1) for seed in seeds]
     else:
         raise ValueError(f"Invalid type for seeds: {type(seeds)}")
-    pipe.scheduler.set_timesteps(num_inference_steps)
+    if schedule is None:
+        pipe.scheduler.set_timesteps(num_inference_steps)
+    else:
+        SCHEDULES[schedule](pipe.scheduler, pipe.orig_sigmas, num_inference_steps)
     unet: CompVisDenoiser = pipe.k_diffusion_model
 
-    if prompt_embeds.shape == negative_prompt_embeds.shape:
-        time_ids = (
-            torch.tensor([height, width, 0, 0, height, width])
-            .repeat(2 * prompt_embeds.size(0), 1)
-            .to(prompt_embeds)
-        )
-        added_cond = {
-            "time_ids": time_ids,
-            "text_embeds": torch.concat(
-                [pooled_prompt_embeds, negative_pooled_prompt_embeds]
-            ),
-        }
-        text_ctx = torch.cat([prompt_embeds, negative_prompt_embeds])
-
-        def cfg_wrapper(x, sigma):
-            cond, uncond = unet(
-                torch.cat([x] * 2),
-                torch.cat([sigma] * 2),
-                cond=text_ctx,
-                added_cond_kwargs=added_cond,
-            ).chunk(2)
-            cfg_output = uncond + guidance_scale * (cond - uncond)
-            return cfg_output
-
-    else:
-        time_ids = torch.tensor([height, width, 0, 0, height, width]).to(prompt_embeds)
-        added_cond_pos = {"time_ids": time_ids, "text_embeds": pooled_prompt_embeds}
-        added_cond_neg = {
-            "time_ids": time_ids,
-            "text_embeds": negative_pooled_prompt_embeds,
-        }
-
-        def cfg_wrapper(x, sigma):
-            cond = unet(x, sigma, cond=prompt_embeds, added_cond_kwargs=added_cond_pos)
-            uncond = unet(
-                x, sigma, cond=negative_prompt_embeds, added_cond_kwargs=added_cond_neg
-            )
-            cfg_output = uncond + guidance_scale * (cond - uncond)
-            return cfg_output
+    text_ctx, ctx_mask = pair_contexts(prompt_embeds, negative_prompt_embeds)
+    time_ids = (
+        torch.tensor([height, width, 0, 0, height, width])
+        .repeat(2 * num_gen, 1)
+        .to(prompt_embeds)
+    )
+    added_cond = {
+        "time_ids": time_ids,
+        "text_embeds": torch.concat(
+            [
+                pooled_prompt_embeds,
+                negative_pooled_prompt_embeds.expand_as(pooled_prompt_embeds),
+            ]
+        ),
+    }
+    added_cond_pos = {
+        "time_ids": time_ids[:num_gen],
+        "text_embeds": pooled_prompt_embeds,
+    }
+    mask_kwargs = {} if ctx_mask is None else {"encoder_attention_mask": ctx_mask}
+    cfg_sigma_min, cfg_sigma_max = guidance_interval
+    unet_evals = {"full": 0, "run": 0}
+
+    def cfg_wrapper(x, sigma):
+        unet_evals["full"] += 2 * x.size(0)
+        if not cfg_sigma_min <= float(sigma[0]) <= cfg_sigma_max:
+            # Outside the guidance interval only the conditional branch runs
+            unet_evals["run"] += x.size(0)
+            return unet(x, sigma, cond=prompt_embeds, added_cond_kwargs=added_cond_pos)
+        unet_evals["run"] += 2 * x.size(0)
+        cond, uncond = unet(
+            torch.cat([x] * 2),
+            torch.cat([sigma] * 2),
+            cond=text_ctx,
+            added_cond_kwargs=added_cond,
+            **mask_kwargs,
+        ).chunk(2)
+        cfg_output = uncond + guidance_scale * (cond - uncond)
+        return cfg_output
 
     sigmas = pipe.scheduler.sigmas
-    x0s = []
-    for i in range(num_gen):
-        set_seed(seeds[i] % 2**32)
-        x0s.append(
-            torch.randn(
-                (1, 4, height // 8, width // 8),
-            ).to(prompt_embeds)
+    shape = (4, height // 8, width // 8)
+    generators = seeded_generators(seeds)
+    x0 = draw_noise(generators, shape, prompt_embeds.device, prompt_embeds.dtype)
+    x0 = x0 * sigmas[0]
+    sampler_kwargs = {}
+    if sampler in STOCHASTIC_SAMPLERS:
+        # Per-step noise continues each sample's own generator, so ancestral
+        # and SDE samplers stay reproducible per seed as well
+        sampler_kwargs["noise_sampler"] = lambda sigma, sigma_next: draw_noise(
+            generators, shape, prompt_embeds.device, prompt_embeds.dtype
         )
-    x0 = torch.concat(x0s) * sigmas[0]
-    result = sample_euler(cfg_wrapper, x0, sigmas.to(prompt_embeds.device))
-    result /= pipe.vae.config.scaling_factor
-    image_tensors = []
-    for latent in result:
-        image_tensors.append(pipe.vae.decode(latent.unsqueeze(0).half()).sample)
-    image_tensors = torch.concat(image_tensors)
-    images = []
-    for image_tensor in image_tensors:
-        images.append(vae_image_postprocess(image_tensor))
-    return images
+    result = SAMPLERS[sampler](
+        cfg_wrapper, x0, sigmas.to(prompt_embeds.device), **sampler_kwargs
+    )
+    if stats is not None:
+        # Per-sample UNet evaluations, and how many the guidance interval saved
+        stats["unet_evals"] = unet_evals["run"]
+        stats["unet_evals_saved"] = unet_evals["full"] - unet_evals["run"]
+    if output_type == "latent":
+        return result
+    return decode_latents(pipe, result, decode_batch_size, tiled_decode)
 
 
 if __name__ == "__main__":
@@ -346,6 +509,7 @@ masterpiece, newest, absurdres, sensitive
                 guidance_scale=6.0,
             )[0]
     t1 = time()
-    print((t1 - t0) / 100)
+    # Per iteration, see dig_client.bench for a per-phase breakdown
+    print((t1 - t0) / 10)
 
     result.save("output/test.png")
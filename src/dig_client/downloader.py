@@ -1,5 +1,9 @@
 import os
+import json
+import random
 import asyncio
+from time import time
+
 import httpx
 
 import orjsonl
@@ -8,30 +12,190 @@ from kgen.utils import remove_repeated_suffix
 
 from . import config
 
+OUTPUT_DIR = "download"
+# One JSON line per finished download, used to skip and resume after a crash
+MANIFEST_FILE = "download/manifest.jsonl"
+CONCURRENCY = 64
+MAX_RETRIES = 8
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30
+
+client = httpx.AsyncClient(
+    http2=True,
+    timeout=3600,
+    limits=httpx.Limits(max_connections=CONCURRENCY),
+)
+
+
+class DownloadStats:
+    def __init__(self):
+        self.downloaded = 0
+        self.skipped = 0
+        self.missing = 0
+        self.failed = 0
+        self.bytes = 0
+        self.start = time()
+
+    def summary(self):
+        elapsed = max(time() - self.start, 1e-6)
+        return (
+            f"{self.downloaded} downloaded, {self.skipped} skipped, "
+            f"{self.missing} not ready, {self.failed} failed, "
+            f"{self.bytes / elapsed / 1024**2:.2f} MB/s, "
+            f"{self.downloaded / elapsed:.1f} images/s"
+        )
+
+
+def load_manifest(path=MANIFEST_FILE):
+    manifest = {}
+    if not os.path.exists(path):
+        return manifest
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # A torn last line from a crash, that file will be fetched again
+                continue
+            manifest[entry["task_id"]] = entry
+    return manifest
+
 
-client = httpx.AsyncClient(http2=True, timeout=3600)
+def is_downloaded(filename, entry):
+    return (
+        entry is not None
+        and os.path.exists(filename)
+        and os.path.getsize(filename) == entry["size"]
+    )
 
 
-async def check_image_status(task_id: str):
-    while True:
+def record_download(manifest: dict, manifest_file, entry: dict):
+    manifest[entry["task_id"]] = entry
+    manifest_file.write(json.dumps(entry) + "\n")
+    manifest_file.flush()
+
+
+async def probe_existing(task_id: str, filename: str):
+    # Manifest entry for a file fetched without one (older downloader runs),
+    # None if the server's copy has another size or can't be checked
+    try:
+        response = await client.head(f"{config.SERVER_URL}/download/{task_id}")
+    except httpx.TransportError:
+        return None
+    size = response.headers.get("content-length")
+    if response.status_code != 200 or size is None:
+        return None
+    if int(size) != os.path.getsize(filename):
+        return None
+    return {"task_id": task_id, "size": int(size), "etag": response.headers.get("etag")}
+
+
+async def download_image(
+    task_id: str, manifest: dict, manifest_file, stats: DownloadStats, revalidate=False
+):
+    filename = os.path.join(OUTPUT_DIR, f"{task_id}.webp")
+    entry = manifest.get(task_id)
+    headers = {}
+    if entry is None and os.path.exists(filename):
+        entry = await probe_existing(task_id, filename)
+        if entry is not None:
+            record_download(manifest, manifest_file, entry)
+            stats.skipped += 1
+            return
+    if is_downloaded(filename, entry):
+        if not revalidate or not entry.get("etag"):
+            stats.skipped += 1
+            return
+        headers["if-none-match"] = entry["etag"]
+
+    error = None
+    for attempt in range(MAX_RETRIES):
         try:
-            response = await client.get(f"{config.SERVER_URL}/download/{task_id}")
-        except httpx.ReadError:
-            continue
-        if response.status_code == 200:
-            # Image is ready
-            os.makedirs("download", exist_ok=True)
-            filename = f"download/{task_id}.webp"
-            with open(filename, "wb") as f:
-                f.write(response.content)
-            print(f"Image downloaded and saved as {filename}")
-            break
-        elif response.status_code == 404:
-            print("Image not ready yet")
-            break
-        else:
-            print(f"Error checking image status: {response.text}")
-            break
+            async with client.stream(
+                "GET", f"{config.SERVER_URL}/download/{task_id}", headers=headers
+            ) as response:
+                if response.status_code == 304:
+                    stats.skipped += 1
+                    return
+                if response.status_code == 404:
+                    stats.missing += 1
+                    return
+                if response.status_code == 200:
+                    # Write through a temp file so an interrupted download
+                    # never looks like a finished one
+                    tmp_filename = f"{filename}.tmp"
+                    size = 0
+                    with open(tmp_filename, "wb") as f:
+                        async for chunk in response.aiter_bytes():
+                            f.write(chunk)
+                            size += len(chunk)
+                    expected = response.headers.get("content-length")
+                    if expected is not None and int(expected) != size:
+                        raise httpx.ReadError(f"Expected {expected} bytes, got {size}")
+                    os.replace(tmp_filename, filename)
+                    entry = {
+                        "task_id": task_id,
+                        "size": size,
+                        "etag": response.headers.get("etag"),
+                    }
+                    record_download(manifest, manifest_file, entry)
+                    stats.downloaded += 1
+                    stats.bytes += size
+                    return
+                if response.status_code != 429 and response.status_code < 500:
+                    await response.aread()
+                    print(f"Error downloading {task_id}: {response.text}")
+                    stats.failed += 1
+                    return
+                error = f"HTTP {response.status_code}"
+        except httpx.TransportError as e:
+            error = e
+        delay = min(BACKOFF_MAX, BACKOFF_BASE * 2**attempt)
+        await asyncio.sleep(delay * random.uniform(0.5, 1.0))
+    print(f"Giving up on {task_id} after {MAX_RETRIES} attempts: {error}")
+    stats.failed += 1
+
+
+async def download_images(
+    task_ids: list[str], concurrency: int = CONCURRENCY, revalidate=False
+):
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    manifest = load_manifest()
+    stats = DownloadStats()
+    queue = asyncio.Queue(maxsize=concurrency * 4)
+    progress = tqdm(total=len(task_ids), desc="Downloading", smoothing=0.05)
+
+    async def worker():
+        while True:
+            task_id = await queue.get()
+            if task_id is None:
+                break
+            try:
+                await download_image(
+                    task_id, manifest, manifest_file, stats, revalidate
+                )
+            except Exception as e:
+                print(f"Error downloading {task_id}: {e}")
+                stats.failed += 1
+            progress.update()
+            if progress.n % 100 == 0:
+                elapsed = max(time() - stats.start, 1e-6)
+                progress.set_postfix(
+                    MBps=f"{stats.bytes / elapsed / 1024**2:.2f}",
+                    skipped=stats.skipped,
+                    failed=stats.failed,
+                )
+
+    with open(MANIFEST_FILE, "a", encoding="utf-8") as manifest_file:
+        workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+        for task_id in task_ids:
+            await queue.put(task_id)
+        for _ in workers:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+    progress.close()
+    print(stats.summary())
+    return stats
 
 
 def load_prompts(file):
@@ -53,14 +217,17 @@ def load_prompts(file):
 
 async def main():
     datas = load_prompts("./data/coyo-output.jsonl")
-    tasks = []
+    task_ids = []
     for entry in datas:
         index, org_prompt1, org_prompt2, gen_prompt1, gen_prompt2 = entry
-        tasks.append(check_image_status(f"coyo-{index}-short"))
-        tasks.append(check_image_status(f"coyo-{index}-tlong"))
-        tasks.append(check_image_status(f"coyo-{index}-short-tipo"))
-        tasks.append(check_image_status(f"coyo-{index}-tlong-tipo"))
-    await asyncio.gather(*tasks[:2000])
+        task_ids.append(f"coyo-{index}-short")
+        task_ids.append(f"coyo-{index}-tlong")
+        task_ids.append(f"coyo-{index}-short-tipo")
+        task_ids.append(f"coyo-{index}-tlong-tipo")
+    try:
+        await download_images(task_ids)
+    finally:
+        await client.aclose()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,147 @@
+import os
+import json
+import hashlib
+from collections import OrderedDict
+
+import torch
+from diffusers import StableDiffusionXLKDiffusionPipeline
+
+from .diff import encode_texts, get_target_length, tokenize
+
+
+def model_identity(pipe: StableDiffusionXLKDiffusionPipeline):
+    return [
+        pipe.tokenizer.name_or_path,
+        pipe.tokenizer_2.name_or_path,
+        pipe.text_encoder.config._name_or_path,
+        pipe.text_encoder_2.config._name_or_path,
+        str(pipe.text_encoder.dtype),
+    ]
+
+
+class PromptEmbeddingCache:
+    # Memoizes per-text (embeds, pooled) pairs from encode_texts.
+    # An in-memory LRU sits in front of an optional on-disk tier, both keyed by
+    # the text, the tokenizer/text encoder identity and the encode options, so
+    # a shared negative prompt or a prompt resubmitted under another task id is
+    # only ever run through the text encoders once.
+    def __init__(
+        self,
+        pipe: StableDiffusionXLKDiffusionPipeline,
+        capacity: int = 1024,
+        cache_dir: str | None = None,
+    ):
+        self.pipe = pipe
+        self.capacity = capacity
+        self.cache_dir = cache_dir
+        self.identity = model_identity(pipe)
+        self.memory = OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, text: str, target_length: int, take_all_eos: bool):
+        payload = json.dumps(
+            [text, target_length, take_all_eos, *self.identity], ensure_ascii=False
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def disk_path(self, key: str):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.pt")
+
+    def get(self, key: str):
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            self.hits += 1
+            return self.memory[key]
+        if self.cache_dir is not None and os.path.exists(self.disk_path(key)):
+            embeds, pooled = torch.load(self.disk_path(key), map_location="cpu")
+            entry = (embeds.to(self.pipe.device), pooled.to(self.pipe.device))
+            self.put(key, entry, write_disk=False)
+            self.disk_hits += 1
+            return entry
+        return None
+
+    def put(self, key: str, entry, write_disk=True):
+        self.memory[key] = entry
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.capacity:
+            self.memory.popitem(last=False)
+        if write_disk and self.cache_dir is not None:
+            path = self.disk_path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.tmp"
+            torch.save((entry[0].cpu(), entry[1].cpu()), tmp_path)
+            os.replace(tmp_path, path)
+
+    @torch.no_grad()
+    def encode_prompts(
+        self,
+        prompt: str | list[str],
+        neg_prompt: str = "",
+        cutoff_length: int | None = 225,
+        take_all_eos: bool = False,
+        target_length: int | None = None,
+        tokens: dict[str, tuple[list[int], list[int]]] | None = None,
+    ):
+        # Same result as diff.encode_prompts with padding_to_max_length=True,
+        # target_length overrides the length derived from cutoff_length.
+        # tokens maps texts to ids the caller already has from diff.tokenize,
+        # other texts are only tokenized if they have to be encoded.
+        if not isinstance(prompt, list):
+            prompt = [prompt]
+        tokens = dict(tokens or {})
+
+        def text_tokens(texts):
+            untokenized = [text for text in texts if text not in tokens]
+            if untokenized:
+                for text, ids, ids2 in zip(
+                    untokenized, *tokenize(self.pipe, untokenized)
+                ):
+                    tokens[text] = (ids, ids2)
+            return [tokens[text][0] for text in texts], [
+                tokens[text][1] for text in texts
+            ]
+
+        if target_length is None:
+            texts = prompt + [neg_prompt]
+            target_length = get_target_length(
+                self.pipe, texts, cutoff_length, text_tokens(texts)
+            )
+        texts = list(dict.fromkeys(prompt + [neg_prompt]))
+        keys = {text: self.key(text, target_length, take_all_eos) for text in texts}
+        entries = {}
+        missing = []
+        for text in texts:
+            entry = self.get(keys[text])
+            if entry is None:
+                missing.append(text)
+            else:
+                entries[text] = entry
+        if missing:
+            self.misses += len(missing)
+            embeds, pooled, _ = encode_texts(
+                self.pipe, missing, target_length, take_all_eos, text_tokens(missing)
+            )
+            for text, embed, pool in zip(missing, embeds, pooled):
+                # Clone so a cached row doesn't keep the whole batch alive
+                entries[text] = (embed.clone(), pool.clone())
+                self.put(keys[text], entries[text])
+
+        embed = torch.stack([entries[text][0] for text in prompt])
+        pooled = torch.stack([entries[text][1] for text in prompt])
+        neg_embed = entries[neg_prompt][0].expand_as(embed)
+        neg_pooled = entries[neg_prompt][1].expand_as(pooled)
+        return (embed, neg_embed), (pooled, neg_pooled)
+
+    def stats(self):
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+            "size": len(self.memory),
+        }
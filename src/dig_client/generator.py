@@ -1,23 +1,91 @@
 import asyncio
 import io
-import random
+import json
+import os
+import socket
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from time import perf_counter
 
 import httpx
 import torch
 from PIL import Image
 
-from .diff import load_model, generate, encode_prompts
+from .diff import (
+    load_model,
+    generate,
+    decode_latents,
+    tokenize,
+    chunk_count,
+)
+from .embed_cache import PromptEmbeddingCache
 from .meta import DEFAULT_NEGATIVE_PROMPT
 from . import config
 
+BATCH_SIZE = 16
+# Lease a whole batch with one /tasks call instead of BATCH_SIZE /task calls
+BATCH_LEASE = True
+WORKER_ID = os.environ.get("DIG_WORKER_ID") or f"{socket.gethostname()}-{os.getpid()}"
+# Leases must outlive a few missed heartbeats, the server reclaims them after
+LEASE_SECONDS = 300
+HEARTBEAT_INTERVAL = 60
+# Seconds the server may park a lease request until work arrives, 0 to poll
+LEASE_WAIT = 30
+# Backoff after failed lease requests, doubling up to the max
+LEASE_RETRY_DELAY = 1
+LEASE_RETRY_MAX_DELAY = 60
+# Cached prompt embeddings live on the GPU, about 1MB each with take_all_eos
+EMBED_CACHE_SIZE = 256
+EMBED_CACHE_DIR = os.environ.get("DIG_EMBED_CACHE_DIR")
+# Pipeline sizing: batches leased ahead of the GPU, sampled batches waiting
+# for encoding, WEBP encoder processes and concurrent uploads
+PREFETCH_BATCHES = 1
+MAX_PENDING_ENCODE = 2
+ENCODE_WORKERS = 4
+UPLOAD_CONCURRENCY = 8
+STATS_INTERVAL = 60
+# Latents decoded per VAE call, tiled decoding trades speed for memory at
+# large resolutions
+DECODE_BATCH_SIZE = 4
+TILED_DECODE = False
+# Classifier-free guidance only runs for sigmas inside this range, below or
+# above it the unconditional UNet branch is skipped
+GUIDANCE_INTERVAL = (0.0, float("inf"))
+# Prompts are padded (or truncated) to CUTOFF_LENGTH tokens. With bucketing
+# the worker leases BUCKET_POOL_SIZE tasks ahead and batches prompts needing
+# the same number of 75 token text encoder chunks, padding only up to those.
+CUTOFF_LENGTH = 225
+LENGTH_BUCKETING = False
+BUCKET_POOL_SIZE = BATCH_SIZE * 4
 
 client = httpx.AsyncClient(timeout=3600)
-pipe = load_model("KBlueLeaf/Kohaku-XL-Zeta", custom_vae=True)
+# Loaded in main() so encoder processes don't load the model when importing us
+pipe = None
+embed_cache = None
+# Task ids currently leased by this worker, kept alive by heartbeat_loop
+held_tasks = set()
+
+
+class LeaseError(Exception):
+    # The server or the connection failed, as opposed to an empty queue
+    pass
 
 
 async def get_task():
     while True:
-        response = await client.get(f"{config.SERVER_URL}/task")
+        try:
+            response = await client.get(
+                f"{config.SERVER_URL}/task",
+                params={
+                    "worker_id": WORKER_ID,
+                    "lease": LEASE_SECONDS,
+                    "wait": LEASE_WAIT,
+                },
+            )
+        except httpx.HTTPError as e:
+            raise LeaseError(f"Error getting task: {e!r}")
         if response.status_code == 200:
             return response.json()
         elif response.status_code == 404:
@@ -27,79 +95,435 @@ async def get_task():
             print("Task was taken by another process, retrying...")
             await asyncio.sleep(0.1)  # Wait a bit before retrying
         else:
-            print(f"Error getting task: {response.text}")
-            return None
+            raise LeaseError(
+                f"Error getting task: {response.status_code} {response.text}"
+            )
 
 
-def generate_image(prompt: str | list[str] = "", seeds=-1):
+async def get_tasks(limit: int = BATCH_SIZE, wait: float = LEASE_WAIT):
+    while True:
+        try:
+            response = await client.get(
+                f"{config.SERVER_URL}/tasks",
+                params={
+                    "limit": limit,
+                    "worker_id": WORKER_ID,
+                    "lease": LEASE_SECONDS,
+                    "wait": wait,
+                },
+            )
+        except httpx.HTTPError as e:
+            raise LeaseError(f"Error getting tasks: {e!r}")
+        if response.status_code == 200:
+            return response.json()
+        elif response.status_code == 409:
+            print("Tasks were taken by another process, retrying...")
+            await asyncio.sleep(0.1)
+        else:
+            raise LeaseError(
+                f"Error getting tasks: {response.status_code} {response.text}"
+            )
+
+
+async def heartbeat_loop():
+    while True:
+        await asyncio.sleep(HEARTBEAT_INTERVAL)
+        task_ids = list(held_tasks)
+        if not task_ids:
+            continue
+        try:
+            response = await client.post(
+                f"{config.SERVER_URL}/heartbeat",
+                json={
+                    "worker_id": WORKER_ID,
+                    "task_ids": task_ids,
+                    "lease": LEASE_SECONDS,
+                },
+            )
+        except httpx.HTTPError as e:
+            print(f"Error sending heartbeat: {e}")
+            continue
+        if response.status_code != 200:
+            print(f"Error sending heartbeat: {response.text}")
+            continue
+        lost = set(task_ids) - set(response.json()["task_ids"])
+        if lost:
+            print(f"Lost lease on tasks: {sorted(lost)}")
+
+
+def sync_device():
+    # Phase timings are only meaningful once queued GPU work has finished
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+
+def generate_image(
+    prompt: str | list[str] = "",
+    seeds=-1,
+    target_length=None,
+    timings: dict | None = None,
+    tokens: dict | None = None,
+    **generate_args,
+):
     torch.cuda.empty_cache()
+    t0 = perf_counter()
     (prompt_embeds, neg_prompt_embeds), (pooled_embeds2, neg_pooled_embeds2) = (
-        encode_prompts(
-            pipe,
+        embed_cache.encode_prompts(
             prompt,
             DEFAULT_NEGATIVE_PROMPT,
+            cutoff_length=CUTOFF_LENGTH,
             take_all_eos=True,
+            target_length=target_length,
+            tokens=tokens,
         )
     )
+    sync_device()
+    t1 = perf_counter()
     torch.cuda.empty_cache()
-    result = generate(
+    stats = {}
+    latents = generate(
         pipe,
         prompt_embeds,
         neg_prompt_embeds,
         pooled_embeds2,
         neg_pooled_embeds2,
         seeds=seeds,
+        guidance_interval=GUIDANCE_INTERVAL,
+        stats=stats,
+        output_type="latent",
+        **generate_args,
+    )
+    sync_device()
+    t2 = perf_counter()
+    result = decode_latents(pipe, latents, DECODE_BATCH_SIZE, TILED_DECODE)
+    t3 = perf_counter()
+    if timings is not None:
+        timings.update(encode=t1 - t0, sample=t2 - t1, decode=t3 - t2)
+    print(
+        f"UNet evaluations: {stats['unet_evals']}, "
+        f"saved by guidance interval: {stats['unet_evals_saved']}"
     )
     torch.cuda.empty_cache()
     return result
 
 
-async def complete_task(task_id: str, image: Image.Image):
+def generation_args(extra_args: dict) -> dict:
+    # Per-task overrides of the generate() defaults, the server hands out
+    # batches whose tasks share them (see BATCH_KEY_ARGS on the server)
+    args = {}
+    if "width" in extra_args:
+        args["width"] = int(extra_args["width"])
+    if "height" in extra_args:
+        args["height"] = int(extra_args["height"])
+    if "steps" in extra_args:
+        args["num_inference_steps"] = int(extra_args["steps"])
+    if "guidance_scale" in extra_args:
+        args["guidance_scale"] = float(extra_args["guidance_scale"])
+    if "sampler" in extra_args:
+        args["sampler"] = extra_args["sampler"]
+    if "schedule" in extra_args:
+        args["schedule"] = extra_args["schedule"]
+    return args
+
+
+def generate_batch(tasks: list[dict], target_length: int | None = None):
+    # Batches leased from /tasks share their parameters. Those assembled from
+    # single /task calls may not, so sample each group of equal args on its own.
+    groups = {}
+    for i, task in enumerate(tasks):
+        key = json.dumps(generation_args(task["extra_args"]), sort_keys=True)
+        groups.setdefault(key, []).append(i)
+    images = [None] * len(tasks)
+    for key, indices in groups.items():
+        timings = {}
+        results = generate_image(
+            [tasks[i]["prompt"] for i in indices],
+            [task_seed(tasks[i]) for i in indices],
+            target_length,
+            timings,
+            # Tokenized once by count_chunks when the batch was leased
+            {tasks[i]["prompt"]: tasks[i]["tokens"] for i in indices},
+            **json.loads(key),
+        )
+        # Every task of a batch waited for the whole batch
+        for i, image in zip(indices, results):
+            images[i] = image
+            tasks[i]["timings"] = dict(timings)
+    return images
+
+
+def encode_image(image: Image.Image) -> bytes:
     img_byte_arr = io.BytesIO()
     image.save(img_byte_arr, format="WEBP", quality=100, lossless=False)
-    img_byte_arr = img_byte_arr.getvalue()
+    return img_byte_arr.getvalue()
+
 
-    files = {"image": ("image.webp", img_byte_arr, "image/webp")}
-    response = await client.post(f"{config.SERVER_URL}/complete/{task_id}", files=files)
+async def complete_task(task_id: str, image_data: bytes, timings: dict = None):
+    files = {"image": ("image.webp", image_data, "image/webp")}
+    # Phase timings in seconds, recorded on the task by the server
+    data = {"timings": json.dumps(timings)} if timings else None
+    response = await client.post(
+        f"{config.SERVER_URL}/complete/{task_id}", files=files, data=data
+    )
     if response.status_code == 200:
         print(f"Task {task_id} completed successfully")
     else:
         print(f"Error completing task: {response.text}")
 
 
-async def main():
-    while True:
-        tasks = []
-        for _ in range(16):
+async def reset_tasks(task_ids: list[str]):
+    await asyncio.gather(
+        *[client.get(f"{config.SERVER_URL}/reset/{task_id}") for task_id in task_ids],
+        return_exceptions=True,
+    )
+
+
+class StageStats:
+    # Busy time per pipeline stage, reported as a share of wall time
+    def __init__(self, workers: dict[str, int]):
+        self.workers = workers
+        self.busy = dict.fromkeys(workers, 0.0)
+        self.start = perf_counter()
+        self.images = 0
+        # Tasks in batches that failed to generate
+        self.failed = 0
+        # Text encoder chunks the prompts need vs. chunks run after padding
+        self.prompt_chunks = 0
+        self.encoded_chunks = 0
+
+    @contextmanager
+    def track(self, stage: str):
+        t0 = perf_counter()
+        try:
+            yield
+        finally:
+            self.busy[stage] += perf_counter() - t0
+
+    def report(self):
+        elapsed = perf_counter() - self.start
+        utilization = ", ".join(
+            f"{stage} {self.busy[stage] / (elapsed * workers) * 100:.0f}%"
+            for stage, workers in self.workers.items()
+        )
+        padding = 1 - self.prompt_chunks / max(self.encoded_chunks, 1)
+        return (
+            f"{self.images / elapsed:.2f} images/s, utilization: {utilization}, "
+            f"text padding {padding * 100:.0f}%, failed {self.failed}"
+        )
+
+
+def task_seed(task: dict) -> int:
+    # The server stores a seed with every task, older rows may use "seeds"
+    extra_args = task["extra_args"]
+    return extra_args.get("seed", extra_args.get("seeds", -1))
+
+
+async def lease_batch():
+    if BATCH_LEASE:
+        return await get_tasks(BATCH_SIZE)
+    tasks = []
+    for _ in range(BATCH_SIZE):
+        try:
             task = await get_task()
-            if task is not None:
-                tasks.append(task)
-            else:
+        except LeaseError:
+            # Keep what is already leased, the next call reports the failure
+            if tasks:
                 break
-        if tasks:
-            print(f"Received task: {tasks}")
+            raise
+        if task is None:
+            break
+        tasks.append(task)
+    return tasks
+
+
+def count_chunks(tasks: list[dict]):
+    # Text encoder chunks each prompt needs, capped at what CUTOFF_LENGTH keeps.
+    # The ids stay on the task so encoding doesn't tokenize the prompt again.
+    tokens = tokenize(pipe, [task["prompt"] for task in tasks])
+    max_chunks = chunk_count(pipe, CUTOFF_LENGTH - 2)
+    for task, ids, ids2 in zip(tasks, *tokens):
+        task["tokens"] = (ids, ids2)
+        length = max(len(ids), len(ids2))
+        task["chunks"] = min(max(chunk_count(pipe, length), 1), max_chunks)
+
+
+def bucket_target_length(chunks: int) -> int:
+    max_length = pipe.tokenizer.model_max_length - 2
+    return min(chunks * max_length + 2, CUTOFF_LENGTH)
+
+
+def take_bucket(bucket_pool: list[dict], neg_chunks: int):
+    # The bucket of the oldest pooled task, so no task waits forever
+    def bucket(task):
+        args = json.dumps(generation_args(task["extra_args"]), sort_keys=True)
+        return args, max(task["chunks"], neg_chunks)
+
+    key = bucket(bucket_pool[0])
+    tasks = [task for task in bucket_pool if bucket(task) == key][:BATCH_SIZE]
+    taken = {id(task) for task in tasks}
+    bucket_pool[:] = [task for task in bucket_pool if id(task) not in taken]
+    return tasks, bucket_target_length(key[1])
+
+
+async def fetch_stage(leased: asyncio.Queue, slots: asyncio.Semaphore, stats):
+    # Leases the next batch while the GPU is still busy with the current one,
+    # a slot is only given back once the sampler picked the batch up
+    bucket_pool = []
+    neg_chunks = chunk_count(pipe, len(tokenize(pipe, [DEFAULT_NEGATIVE_PROMPT])[0][0]))
+    failures = 0
+    while True:
+        await slots.acquire()
+        with stats.track("fetch"):
             try:
-                images = generate_image(
-                    [task["prompt"] for task in tasks],
-                    [task["extra_args"].get("seeds", -1) for task in tasks],
+                if LENGTH_BUCKETING:
+                    # Only long-poll when there is nothing pooled to hand out
+                    new_tasks = await get_tasks(
+                        BUCKET_POOL_SIZE - len(bucket_pool),
+                        0 if bucket_pool else LEASE_WAIT,
+                    )
+                else:
+                    new_tasks = await lease_batch()
+                failures = 0
+            except LeaseError as e:
+                print(e)
+                new_tasks = []
+                failures += 1
+            if new_tasks:
+                held_tasks.update(task["task_id"] for task in new_tasks)
+                await asyncio.to_thread(count_chunks, new_tasks)
+            if LENGTH_BUCKETING:
+                bucket_pool.extend(new_tasks)
+                tasks, target_length = (
+                    take_bucket(bucket_pool, neg_chunks) if bucket_pool else ([], None)
                 )
-                await asyncio.gather(
-                    *[
-                        complete_task(task["task_id"], image)
-                        for task, image in zip(tasks, images)
-                    ]
-                )
-            except Exception as e:
-                await asyncio.gather(
-                    *[
-                        client.get(f"{config.SERVER_URL}/reset/{task['task_id']}")
-                        for task in tasks
-                    ]
+            else:
+                tasks, target_length = new_tasks, CUTOFF_LENGTH
+        if not tasks:
+            slots.release()
+            if failures:
+                # Without this a failing server would see a tight request loop,
+                # the long-poll only paces an empty queue
+                delay = min(
+                    LEASE_RETRY_MAX_DELAY, LEASE_RETRY_DELAY * 2 ** (failures - 1)
                 )
-                raise e
-        else:
+                print(f"Leasing failed, retrying in {delay}s")
+                await asyncio.sleep(delay)
+                continue
             print("No task available, waiting...")
-            await asyncio.sleep(0.5)
+            if not LEASE_WAIT:
+                await asyncio.sleep(0.5)
+            continue
+        stats.prompt_chunks += sum(task["chunks"] for task in tasks)
+        stats.encoded_chunks += len(tasks) * chunk_count(pipe, target_length - 2)
+        await leased.put((tasks, target_length))
+
+
+async def sample_stage(
+    leased: asyncio.Queue, slots: asyncio.Semaphore, generated: asyncio.Queue, stats
+):
+    while True:
+        tasks, target_length = await leased.get()
+        slots.release()
+        print(f"Received tasks: {[task['task_id'] for task in tasks]}")
+        try:
+            with stats.track("sample"):
+                # Sampling runs in a thread so the loop keeps fetching,
+                # uploading and heartbeating
+                images = await asyncio.to_thread(generate_batch, tasks, target_length)
+        except Exception:
+            # Fail the batch, not the worker. Its leases run out and the reaper
+            # hands the tasks out again, so a task that can't be generated
+            # doesn't bounce between workers in a tight loop.
+            traceback.print_exc()
+            held_tasks.difference_update(task["task_id"] for task in tasks)
+            stats.failed += len(tasks)
+            continue
+        print(f"Prompt embedding cache: {embed_cache.stats()}")
+        generated_at = perf_counter()
+        for task in tasks:
+            task["generated_at"] = generated_at
+        await generated.put((tasks, images))
+
+
+async def encode_stage(
+    generated: asyncio.Queue, encoded: asyncio.Queue, pool: ProcessPoolExecutor, stats
+):
+    loop = asyncio.get_running_loop()
+    while True:
+        tasks, images = await generated.get()
+        with stats.track("encode"):
+            datas = await asyncio.gather(
+                *[loop.run_in_executor(pool, encode_image, image) for image in images]
+            )
+        for task, data in zip(tasks, datas):
+            await encoded.put((task, data))
+
+
+async def upload_stage(encoded: asyncio.Queue, stats):
+    while True:
+        task, data = await encoded.get()
+        task_id = task["task_id"]
+        # WEBP encoding and queueing up to the request, the request itself
+        # can't report its own duration
+        timings = {
+            **task.get("timings", {}),
+            "postprocess": perf_counter() - task["generated_at"],
+        }
+        try:
+            with stats.track("upload"):
+                await complete_task(task_id, data, timings)
+        except httpx.HTTPError as e:
+            # The lease runs out and the server hands the task out again
+            print(f"Error completing task {task_id}: {e}")
+        held_tasks.discard(task_id)
+        stats.images += 1
+
+
+async def stats_loop(stats: StageStats, queues: dict[str, asyncio.Queue]):
+    while True:
+        await asyncio.sleep(STATS_INTERVAL)
+        depths = ", ".join(f"{name} {queue.qsize()}" for name, queue in queues.items())
+        print(f"Pipeline: {stats.report()}, queued: {depths}")
+
+
+async def main():
+    global pipe, embed_cache
+    pipe = load_model("KBlueLeaf/Kohaku-XL-Zeta", custom_vae=True)
+    embed_cache = PromptEmbeddingCache(pipe, EMBED_CACHE_SIZE, EMBED_CACHE_DIR)
+
+    # fetch -> leased -> sample (GPU) -> generated -> encode (processes)
+    # -> encoded -> upload, with bounded queues so no stage runs far ahead
+    leased = asyncio.Queue()
+    slots = asyncio.Semaphore(PREFETCH_BATCHES)
+    generated = asyncio.Queue(maxsize=MAX_PENDING_ENCODE)
+    encoded = asyncio.Queue(maxsize=BATCH_SIZE * 2)
+    stats = StageStats(
+        {"fetch": 1, "sample": 1, "encode": 1, "upload": UPLOAD_CONCURRENCY}
+    )
+    pool = ProcessPoolExecutor(
+        ENCODE_WORKERS, mp_context=multiprocessing.get_context("spawn")
+    )
+    stages = [
+        fetch_stage(leased, slots, stats),
+        sample_stage(leased, slots, generated, stats),
+        encode_stage(generated, encoded, pool, stats),
+        *[upload_stage(encoded, stats) for _ in range(UPLOAD_CONCURRENCY)],
+        heartbeat_loop(),
+        stats_loop(
+            stats, {"leased": leased, "generated": generated, "encoded": encoded}
+        ),
+    ]
+    stages = [asyncio.create_task(stage) for stage in stages]
+    try:
+        await asyncio.gather(*stages)
+    finally:
+        for stage in stages:
+            stage.cancel()
+        # Hand whatever we still hold back to the queue instead of waiting for
+        # the leases to expire
+        if held_tasks:
+            await reset_tasks(list(held_tasks))
+        pool.shutdown(cancel_futures=True)
 
 
 if __name__ == "__main__":
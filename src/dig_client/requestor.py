@@ -1,4 +1,5 @@
 import asyncio
+import json
 import httpx
 from . import config
 
@@ -7,25 +8,35 @@ semaphore = asyncio.Semaphore(512)
 client = httpx.AsyncClient(timeout=3600, limits=httpx.Limits(max_connections=512))
 
 
-async def request_image_generation(prompt: str, task_id: str = None, seed: int = None):
-    extra_args = {}
+def build_request(prompt: str, task_id: str = None, seed: int = None, **generate_args):
+    # generate_args: width, height, steps, guidance_scale, sampler, schedule
+    extra_args = dict(generate_args)
     if task_id is not None:
         extra_args["task_id"] = task_id
     if seed is not None:
         extra_args["seed"] = seed
+    return {"prompt": prompt, "extra_args": extra_args}
+
+
+async def request_image_generation(
+    prompt: str, task_id: str = None, seed: int = None, **generate_args
+):
+    # generate_args as in build_request
     async with semaphore:
         for _ in range(5):
             try:
                 response = await client.post(
                     f"{config.SERVER_URL}/request",
-                    json={"prompt": prompt, "extra_args": extra_args},
+                    json=build_request(prompt, task_id, seed, **generate_args),
                 )
                 break
             except Exception as e:
+                # `e` is unbound once the except block ends
+                last_error = e
                 await asyncio.sleep(1)
                 continue
         else:
-            print(e)
+            print(last_error)
             return None
     if response.status_code == 200:
         task_id = response.json()["task_id"]
@@ -36,5 +47,36 @@ async def request_image_generation(prompt: str, task_id: str = None, seed: int =
         return None
 
 
+async def request_image_generation_bulk(requests: list[dict], chunk_size=50000):
+    # Sends build_request() payloads as NDJSON, the server upserts them in
+    # chunked transactions instead of one round-trip per prompt.
+    task_ids = []
+    for i in range(0, len(requests), chunk_size):
+        body = "\n".join(
+            json.dumps(request, ensure_ascii=False)
+            for request in requests[i : i + chunk_size]
+        ).encode("utf-8")
+        for _ in range(5):
+            try:
+                response = await client.post(
+                    f"{config.SERVER_URL}/requests",
+                    content=body,
+                    headers={"Content-Type": "application/x-ndjson"},
+                )
+                break
+            except Exception as e:
+                last_error = e
+                await asyncio.sleep(1)
+                continue
+        else:
+            print(f"Error creating tasks: {last_error!r}")
+            return task_ids
+        if response.status_code != 200:
+            print(f"Error creating tasks: {response.text}")
+            return task_ids
+        task_ids.extend(response.json()["task_ids"])
+    return task_ids
+
+
 async def cleanup():
     await client.aclose()
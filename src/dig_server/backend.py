@@ -0,0 +1,362 @@
+import os
+import heapq
+import random
+import asyncio
+import datetime
+import hashlib
+
+from .db import (
+    MODELS,
+    database_proxy,
+    Task,
+    open_database,
+    initialize_db,
+    create_tables,
+    lease_tasks,
+    upsert_tasks,
+    extend_leases,
+    reset_tasks,
+    mark_completed,
+    reclaim_expired_tasks,
+    queue_stats,
+    completed_images,
+    task_counts,
+    completion_report,
+    completion_counts,
+    completion_rows,
+    queue_summary,
+    completion_summary,
+    completed_by_hash,
+    link_pending,
+    hold_tasks,
+    processing_copies,
+    lease_deadline,
+    set_image_paths,
+)
+from .executor import DBExecutor
+
+
+class QueueBackend:
+    # What the server needs from a task store. Tasks handed out by get() and
+    # lease() only need the attributes the endpoints read: task_id, prompt,
+    # extra_args (JSON text), status and image_path.
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    async def submit(self, rows: list[dict]):
+        # rows as built by prompt_request_to_row, re-submitting a task id
+        # puts it back into the queue
+        raise NotImplementedError
+
+    async def lease(self, limit, worker_id, lease_seconds, batch_key=None):
+        raise NotImplementedError
+
+    async def extend_leases(self, worker_id, task_ids, lease_seconds):
+        raise NotImplementedError
+
+    async def reset(self, task_ids) -> int:
+        raise NotImplementedError
+
+    async def complete(self, task_id, image_path, timings=None) -> int:
+        raise NotImplementedError
+
+    async def reclaim_expired(self) -> int:
+        raise NotImplementedError
+
+    async def get(self, task_id):
+        raise NotImplementedError
+
+    async def task_counts(self) -> dict:
+        raise NotImplementedError
+
+    async def queue_stats(self) -> dict:
+        raise NotImplementedError
+
+    async def completion_report(self, window) -> dict:
+        raise NotImplementedError
+
+    async def completed_images(
+        self, task_ids=None, prefix=None, after=None, limit=1000
+    ):
+        raise NotImplementedError
+
+    async def set_image_paths(self, paths: dict[str, str]) -> int:
+        # task_id -> image_path, moves completed images without touching status
+        raise NotImplementedError
+
+
+class SqliteBackend(QueueBackend):
+    # The peewee Task table, all calls go through a DBExecutor
+    def __init__(self, db_path="db/image_tasks.db", max_batch=256, readers=4):
+        self.db_path = db_path
+        self.executor = DBExecutor(database_proxy, max_batch=max_batch, readers=readers)
+
+    def start(self):
+        initialize_db(self.db_path)
+        create_tables()
+        self.executor.start()
+
+    def stop(self):
+        self.executor.stop()
+        if not database_proxy.obj.is_closed():
+            database_proxy.obj.close()
+
+    async def submit(self, rows):
+        return await self.executor.run(upsert_tasks, rows)
+
+    async def lease(self, limit, worker_id, lease_seconds, batch_key=None):
+        return await self.executor.run(
+            lease_tasks, limit, worker_id, lease_seconds, batch_key
+        )
+
+    async def extend_leases(self, worker_id, task_ids, lease_seconds):
+        return await self.executor.run(
+            extend_leases, worker_id, task_ids, lease_seconds
+        )
+
+    async def reset(self, task_ids):
+        return await self.executor.run(reset_tasks, task_ids)
+
+    async def complete(self, task_id, image_path, timings=None):
+        return await self.executor.run(mark_completed, task_id, image_path, timings)
+
+    async def reclaim_expired(self):
+        return await self.executor.run(reclaim_expired_tasks)
+
+    async def get(self, task_id):
+        return await self.executor.read(Task.get_or_none, Task.task_id == task_id)
+
+    async def task_counts(self):
+        return await self.executor.read(task_counts)
+
+    async def queue_stats(self):
+        return await self.executor.read(queue_stats)
+
+    async def completion_report(self, window):
+        return await self.executor.read(completion_report, window)
+
+    async def completed_images(
+        self, task_ids=None, prefix=None, after=None, limit=1000
+    ):
+        return await self.executor.read(
+            completed_images, task_ids=task_ids, prefix=prefix, after=after, limit=limit
+        )
+
+    async def set_image_paths(self, paths):
+        return await self.executor.run(set_image_paths, paths)
+
+
+def shard_paths(db_path: str, shards: int) -> list[str]:
+    # db/image_tasks.db -> db/image_tasks.0.db, db/image_tasks.1.db, ...
+    root, ext = os.path.splitext(db_path)
+    return [f"{root}.{i}{ext}" for i in range(shards)]
+
+
+def shard_index(task_id: str, shards: int) -> int:
+    # Stable across processes, unlike hash()
+    digest = hashlib.sha256(task_id.encode("utf-8")).digest()
+    return int.from_bytes(digest[:4], "big") % shards
+
+
+class ShardedSqliteBackend(QueueBackend):
+    # Tasks spread over several SQLite files by task_id hash, each with its own
+    # DBExecutor, so writes to different shards commit in parallel, also
+    # across server processes. Leases start at the next shard in turn and
+    # move on while the batch isn't full. FIFO order holds per shard only.
+    # Identical requests can live on any shard, so deduplication looks at all
+    # of them.
+    # The shard count must stay the same for the lifetime of the files.
+    def __init__(self, db_path="db/image_tasks.db", shards=4, max_batch=256, readers=2):
+        self.paths = shard_paths(db_path, shards)
+        self.max_batch = max_batch
+        self.readers = readers
+        self.executors = []
+        # Processes start at different shards so they don't lease in lockstep
+        self.next_shard = random.randrange(shards)
+
+    def start(self):
+        for i, path in enumerate(self.paths):
+            database = open_database(path)
+            create_tables(database)
+            executor = DBExecutor(
+                database,
+                max_batch=self.max_batch,
+                readers=self.readers,
+                models=MODELS,
+                name=f"dig-db-{i}",
+            )
+            executor.start()
+            self.executors.append(executor)
+
+    def stop(self):
+        for executor in self.executors:
+            executor.stop()
+            if not executor.database.is_closed():
+                executor.database.close()
+        self.executors = []
+
+    def shard(self, task_id):
+        return self.executors[shard_index(task_id, len(self.executors))]
+
+    def group(self, items, key=lambda item: item):
+        groups = {}
+        for item in items:
+            groups.setdefault(shard_index(key(item), len(self.executors)), []).append(
+                item
+            )
+        return [(self.executors[i], group) for i, group in groups.items()]
+
+    async def each_shard(self, fn, *args, write=False):
+        return await asyncio.gather(
+            *(
+                (executor.run if write else executor.read)(fn, *args)
+                for executor in self.executors
+            )
+        )
+
+    async def submit(self, rows):
+        hashes = {row["content_hash"] for row in rows if row.get("content_hash")}
+        linked = {}
+        for shard_linked in await self.each_shard(completed_by_hash, hashes):
+            linked.update(shard_linked)
+        counts = await asyncio.gather(
+            *(
+                executor.run(upsert_tasks, group, linked)
+                for executor, group in self.group(rows, key=lambda row: row["task_id"])
+            )
+        )
+        return sum(counts)
+
+    async def lease(self, limit, worker_id, lease_seconds, batch_key=None):
+        start = self.next_shard
+        self.next_shard = (start + 1) % len(self.executors)
+        tasks = []
+        for i in range(len(self.executors)):
+            executor = self.executors[(start + i) % len(self.executors)]
+            tasks += await executor.run(
+                lease_tasks, limit - len(tasks), worker_id, lease_seconds, batch_key
+            )
+            if len(tasks) >= limit:
+                break
+            if tasks:
+                # The rest of the batch has to match what this shard handed out
+                batch_key = tasks[0].batch_key
+        return await self.first_copies(tasks, lease_seconds)
+
+    async def first_copies(self, tasks, lease_seconds):
+        # Each shard only holds back copies of its own tasks. Of the copies
+        # being generated across shards, the one leased first keeps going and
+        # the others are held back until it would have expired, to be linked
+        # once it completes.
+        hashes = {task.content_hash for task in tasks if task.content_hash}
+        if not hashes:
+            return tasks
+        first = {}
+        for copies in await self.each_shard(processing_copies, hashes):
+            for content_hash, leased_at, task_id in copies:
+                order = (leased_at or datetime.datetime.min, task_id)
+                first[content_hash] = min(first.get(content_hash, order), order)
+        held = {
+            task.task_id
+            for task in tasks
+            if task.content_hash
+            and first.get(task.content_hash, ()) < (task.leased_at, task.task_id)
+        }
+        if not held:
+            return tasks
+        until = lease_deadline(lease_seconds)
+        await asyncio.gather(
+            *(
+                executor.run(hold_tasks, group, until)
+                for executor, group in self.group(held)
+            )
+        )
+        return [task for task in tasks if task.task_id not in held]
+
+    async def extend_leases(self, worker_id, task_ids, lease_seconds):
+        held = await asyncio.gather(
+            *(
+                executor.run(extend_leases, worker_id, group, lease_seconds)
+                for executor, group in self.group(task_ids)
+            )
+        )
+        return [task_id for group in held for task_id in group]
+
+    async def reset(self, task_ids):
+        counts = await asyncio.gather(
+            *(
+                executor.run(reset_tasks, group)
+                for executor, group in self.group(task_ids)
+            )
+        )
+        return sum(counts)
+
+    async def complete(self, task_id, image_path, timings=None):
+        shard = self.shard(task_id)
+        completed = await shard.run(mark_completed, task_id, image_path, timings)
+        task = await self.get(task_id) if completed else None
+        if task is not None and task.content_hash:
+            # mark_completed took care of the duplicates on its own shard
+            await asyncio.gather(
+                *(
+                    executor.run(link_pending, task.content_hash, task_id, image_path)
+                    for executor in self.executors
+                    if executor is not shard
+                )
+            )
+        return completed
+
+    async def reclaim_expired(self):
+        return sum(await self.each_shard(reclaim_expired_tasks, write=True))
+
+    async def get(self, task_id):
+        return await self.shard(task_id).read(Task.get_or_none, Task.task_id == task_id)
+
+    async def task_counts(self):
+        counts = {}
+        for shard_counts in await self.each_shard(task_counts):
+            for status, count in shard_counts.items():
+                counts[status] = counts.get(status, 0) + count
+        return counts
+
+    async def queue_stats(self):
+        counts = await self.task_counts()
+        completions = {}
+        for shard_completions in await self.each_shard(completion_counts):
+            for window, count in shard_completions.items():
+                completions[window] = completions.get(window, 0) + count
+        return queue_summary(counts, completions)
+
+    async def completion_report(self, window):
+        rows = await self.each_shard(completion_rows, window)
+        return completion_summary([row for shard in rows for row in shard], window)
+
+    async def completed_images(
+        self, task_ids=None, prefix=None, after=None, limit=1000
+    ):
+        if task_ids is not None:
+            pages = await asyncio.gather(
+                *(
+                    executor.read(completed_images, task_ids=group, limit=limit)
+                    for executor, group in self.group(task_ids)
+                )
+            )
+        else:
+            pages = await self.each_shard(completed_images, None, prefix, after, limit)
+        # Every shard's page is sorted by task id, so are the first `limit` of
+        # their merge
+        return list(heapq.merge(*pages))[:limit]
+
+    async def set_image_paths(self, paths):
+        counts = await asyncio.gather(
+            *(
+                executor.run(set_image_paths, dict(group))
+                for executor, group in self.group(
+                    paths.items(), key=lambda item: item[0]
+                )
+            )
+        )
+        return sum(counts)
@@ -1,5 +1,9 @@
 from peewee import *
+from playhouse.migrate import SqliteMigrator, migrate
+from playhouse.shortcuts import ThreadSafeDatabaseMetadata
 import datetime
+import hashlib
+import json
 import os
 
 database_proxy = DatabaseProxy()
@@ -8,6 +12,10 @@ database_proxy = DatabaseProxy()
 class BaseModel(Model):
     class Meta:
         database = database_proxy
+        # Bindings made with Database.bind() only apply to the calling thread,
+        # so each shard's DBExecutor threads can point the models at their own
+        # file. Unbound threads use database_proxy.
+        model_metadata_class = ThreadSafeDatabaseMetadata
 
 
 class Task(BaseModel):
@@ -17,10 +25,360 @@ class Task(BaseModel):
     image_path = CharField(null=True)
     status = CharField(default="pending")  # pending, processing, completed
     created_at = DateTimeField(default=datetime.datetime.now)
+    worker_id = CharField(null=True)
+    lease_expires_at = DateTimeField(null=True)
+    completed_at = DateTimeField(null=True, index=True)
+    leased_at = DateTimeField(null=True)
+    # Leases handed out for this task, more than one means it was retried
+    attempts = IntegerField(default=0)
+    # Phase timings in seconds as reported by the worker on completion
+    encode_seconds = FloatField(null=True)
+    sample_seconds = FloatField(null=True)
+    decode_seconds = FloatField(null=True)
+    # From the decoded image to the start of its upload: WEBP encoding and
+    # waiting for an upload slot. The upload itself can't be in its own request.
+    postprocess_seconds = FloatField(null=True)
+    # Tasks sharing a batch key can be sampled in one batch, see batch_key()
+    batch_key = CharField(default="")
+    # Identical requests share a content hash, see content_hash()
+    content_hash = CharField(null=True, index=True)
+    # Task whose image this one reuses instead of being generated
+    linked_from = CharField(null=True)
 
+    class Meta:
+        indexes = (
+            (("status", "created_at"), False),
+            (("status", "lease_expires_at"), False),
+            (("status", "batch_key", "created_at"), False),
+            # Lets leasable() look for earlier copies of a task with two seeks
+            (("content_hash", "status", "id"), False),
+        )
 
-def initialize_db(db_path="db/image_tasks.db"):
-    database = SqliteDatabase(
+
+class TaskCount(BaseModel):
+    # Per-status row counts, kept in sync with Task by the triggers below so
+    # queue stats never need to scan the task table.
+    status = CharField(primary_key=True)
+    count = IntegerField(default=0)
+
+
+MODELS = [Task, TaskCount]
+
+
+TASK_COUNT_TRIGGERS = [
+    """
+    CREATE TRIGGER IF NOT EXISTS task_count_insert AFTER INSERT ON task
+    BEGIN
+        INSERT INTO taskcount (status, count) VALUES (NEW.status, 1)
+        ON CONFLICT (status) DO UPDATE SET count = count + 1;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS task_count_delete AFTER DELETE ON task
+    BEGIN
+        UPDATE taskcount SET count = count - 1 WHERE status = OLD.status;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS task_count_update AFTER UPDATE OF status ON task
+    WHEN OLD.status != NEW.status
+    BEGIN
+        UPDATE taskcount SET count = count - 1 WHERE status = OLD.status;
+        INSERT INTO taskcount (status, count) VALUES (NEW.status, 1)
+        ON CONFLICT (status) DO UPDATE SET count = count + 1;
+    END
+    """,
+]
+STATS_WINDOWS = (60, 300, 900, 3600)
+# extra_args that change the shape or the sampling loop of a batch
+BATCH_KEY_ARGS = (
+    "width",
+    "height",
+    "steps",
+    "guidance_scale",
+    "sampler",
+    "schedule",
+)
+TIMING_PHASES = ("encode", "sample", "decode", "postprocess")
+LATENCY_NAMES = ("queue_wait", "processing", "total", *TIMING_PHASES)
+REPORT_PERCENTILES = (50, 95, 99)
+
+
+DEFAULT_LEASE_SECONDS = 300
+
+
+def lease_deadline(lease_seconds=DEFAULT_LEASE_SECONDS):
+    return datetime.datetime.now() + datetime.timedelta(seconds=lease_seconds)
+
+
+def batch_key(extra_args: dict) -> str:
+    # "" for tasks using the worker defaults
+    return ",".join(
+        f"{name}={extra_args[name]}" for name in BATCH_KEY_ARGS if name in extra_args
+    )
+
+
+def content_hash(prompt: str, extra_args: dict, model: str = "") -> str:
+    # Everything that decides the image: the prompt, every generation argument
+    # (seed, size, steps, sampler, negative prompt, ...) and the model
+    payload = json.dumps(
+        [prompt, extra_args, model], sort_keys=True, ensure_ascii=False
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def leasable(now):
+    # Pending tasks that no other task with the same content hash is ahead of
+    # in the queue or being generated. Later copies wait for that task's
+    # image, which link_pending hands them when it completes. Tasks held back
+    # by hold_tasks wait until their hold runs out.
+    # Two lookups rather than one with an OR, so each is a single seek on the
+    # (content_hash, status, id) index
+    processing = Task.alias()
+    earlier = Task.alias()
+    return (
+        (Task.status == "pending")
+        & (Task.lease_expires_at.is_null() | (Task.lease_expires_at < now))
+        & (
+            Task.content_hash.is_null()
+            | (
+                ~fn.EXISTS(
+                    processing.select(SQL("1")).where(
+                        (processing.content_hash == Task.content_hash)
+                        & (processing.status == "processing")
+                    )
+                )
+                & ~fn.EXISTS(
+                    earlier.select(SQL("1")).where(
+                        (earlier.content_hash == Task.content_hash)
+                        & (earlier.status == "pending")
+                        & (earlier.id < Task.id)
+                    )
+                )
+            )
+        )
+    )
+
+
+def lease_tasks(
+    limit=1, worker_id=None, lease_seconds=DEFAULT_LEASE_SECONDS, batch_key=None
+):
+    # Claim up to `limit` oldest pending tasks with a single UPDATE ... RETURNING
+    # so concurrent workers never see the same row and a batch costs one write.
+    # Only tasks sharing the batch key of the oldest pending task (or the given
+    # one) are claimed together, so a batch never mixes shapes or samplers.
+    # Only the first copy of identical requests is handed out.
+    now = datetime.datetime.now()
+    if batch_key is None:
+        batch_key = (
+            Task.select(Task.batch_key)
+            .where(leasable(now))
+            .order_by(Task.created_at)
+            .limit(1)
+        )
+    pending = (
+        Task.select(Task.id)
+        .where(leasable(now) & (Task.batch_key == batch_key))
+        .order_by(Task.created_at)
+        .limit(limit)
+    )
+    tasks = (
+        Task.update(
+            status="processing",
+            worker_id=worker_id,
+            lease_expires_at=lease_deadline(lease_seconds),
+            leased_at=now,
+            attempts=Task.attempts + 1,
+        )
+        .where(Task.id.in_(pending))
+        .returning(Task)
+        .execute()
+    )
+    return sorted(tasks, key=lambda task: task.created_at)
+
+
+def completed_by_hash(hashes):
+    # content_hash -> (task_id, image_path) of a completed task with that hash
+    if not hashes:
+        return {}
+    query = Task.select(Task.content_hash, Task.task_id, Task.image_path).where(
+        (Task.content_hash.in_(list(hashes)))
+        & (Task.status == "completed")
+        & (Task.image_path.is_null(False))
+    )
+    return {content_hash: source for content_hash, *source in query.tuples()}
+
+
+def link_row(row, source, now):
+    # A request with the content hash of a completed task is completed right
+    # away with that task's image
+    if source is None:
+        return {
+            "content_hash": None,
+            **row,
+            "status": "pending",
+            "image_path": None,
+            "completed_at": None,
+            "linked_from": None,
+        }
+    task_id, image_path = source
+    return {
+        "content_hash": None,
+        **row,
+        "status": "completed",
+        "image_path": image_path,
+        "completed_at": now,
+        "linked_from": task_id,
+    }
+
+
+def upsert_tasks(rows, linked=None):
+    # Re-submitting an existing task_id puts it back into the queue with the new
+    # prompt, in a single INSERT ... ON CONFLICT. Re-submitting it unchanged
+    # (same content hash) leaves it alone, whatever its state.
+    # `linked` is completed_by_hash() for the rows, the sharded store looks it
+    # up across every shard.
+    if not rows:
+        return 0
+    if linked is None:
+        linked = completed_by_hash(
+            {row["content_hash"] for row in rows if row.get("content_hash")}
+        )
+    now = datetime.datetime.now()
+    rows = [link_row(row, linked.get(row.get("content_hash")), now) for row in rows]
+    return (
+        Task.insert_many(rows)
+        .on_conflict(
+            conflict_target=[Task.task_id],
+            update={
+                Task.status: EXCLUDED.status,
+                Task.prompt: EXCLUDED.prompt,
+                Task.extra_args: EXCLUDED.extra_args,
+                Task.batch_key: EXCLUDED.batch_key,
+                Task.content_hash: EXCLUDED.content_hash,
+                Task.image_path: EXCLUDED.image_path,
+                Task.completed_at: EXCLUDED.completed_at,
+                Task.linked_from: EXCLUDED.linked_from,
+                Task.worker_id: None,
+                Task.lease_expires_at: None,
+                Task.attempts: 0,
+            },
+            where=(
+                Task.content_hash.is_null()
+                | (Task.content_hash != EXCLUDED.content_hash)
+            ),
+        )
+        .execute()
+    )
+
+
+def extend_leases(worker_id, task_ids, lease_seconds=DEFAULT_LEASE_SECONDS):
+    # Returns the task ids this worker still holds, so it can notice lost leases.
+    held = (
+        Task.update(lease_expires_at=lease_deadline(lease_seconds))
+        .where(
+            (Task.task_id.in_(task_ids))
+            & (Task.worker_id == worker_id)
+            & (Task.status == "processing")
+        )
+        .returning(Task.task_id)
+        .execute()
+    )
+    return [task.task_id for task in held]
+
+
+def hold_tasks(task_ids, until):
+    # Hands leased tasks back before any work was done, lease_tasks skips them
+    # until `until`. The lease_expires_at of a pending task is its hold.
+    return (
+        Task.update(
+            status="pending",
+            worker_id=None,
+            lease_expires_at=until,
+            attempts=Task.attempts - 1,
+        )
+        .where((Task.task_id.in_(task_ids)) & (Task.status == "processing"))
+        .execute()
+    )
+
+
+def processing_copies(hashes):
+    # (content_hash, leased_at, task_id) of the tasks being generated for
+    # these content hashes
+    if not hashes:
+        return []
+    query = Task.select(Task.content_hash, Task.leased_at, Task.task_id).where(
+        (Task.content_hash.in_(list(hashes))) & (Task.status == "processing")
+    )
+    return list(query.tuples())
+
+
+def reset_tasks(task_ids):
+    # A reset linked task gets generated on its own, it is no longer linked
+    return (
+        Task.update(
+            status="pending", worker_id=None, lease_expires_at=None, linked_from=None
+        )
+        .where(Task.task_id.in_(task_ids))
+        .execute()
+    )
+
+
+def mark_completed(task_id, image_path, timings=None):
+    # Only completes tasks that are still leased, so the status check and the
+    # update can't race with the reaper or a reset.
+    # Pending duplicates of the task are completed with the same image.
+    timings = timings or {}
+    now = datetime.datetime.now()
+    completed = list(
+        Task.update(
+            status="completed",
+            image_path=image_path,
+            lease_expires_at=None,
+            completed_at=now,
+            linked_from=None,
+            **{f"{phase}_seconds": timings.get(phase) for phase in TIMING_PHASES},
+        )
+        .where((Task.task_id == task_id) & (Task.status == "processing"))
+        .returning(Task.content_hash)
+        .execute()
+    )
+    if completed and completed[0].content_hash:
+        link_pending(completed[0].content_hash, task_id, image_path, now)
+    return len(completed)
+
+
+def link_pending(content_hash, task_id, image_path, now=None):
+    # Completes pending tasks with this content hash using task_id's image
+    return (
+        Task.update(
+            status="completed",
+            image_path=image_path,
+            completed_at=now or datetime.datetime.now(),
+            linked_from=task_id,
+            lease_expires_at=None,
+        )
+        .where((Task.content_hash == content_hash) & (Task.status == "pending"))
+        .execute()
+    )
+
+
+def reclaim_expired_tasks(now=None):
+    # Rows leased before lease deadlines existed have no deadline; treat them as
+    # expired so they get back into the queue too.
+    now = now or datetime.datetime.now()
+    return (
+        Task.update(status="pending", worker_id=None, lease_expires_at=None)
+        .where(
+            (Task.status == "processing")
+            & ((Task.lease_expires_at < now) | (Task.lease_expires_at.is_null()))
+        )
+        .execute()
+    )
+
+
+def open_database(db_path="db/image_tasks.db"):
+    return SqliteDatabase(
         db_path,
         pragmas={
             "journal_mode": "wal",
@@ -32,12 +390,204 @@ def initialize_db(db_path="db/image_tasks.db"):
             "ignore_check_constraints": 0,
         },
     )
-    database_proxy.initialize(database)
 
 
-def create_tables():
-    with database_proxy.obj:
-        database_proxy.obj.create_tables([Task], safe=True)
+def initialize_db(db_path="db/image_tasks.db"):
+    database_proxy.initialize(open_database(db_path))
+
+
+def completed_images(task_ids=None, prefix=None, after=None, limit=1000):
+    # Pages through completed (task_id, image_path) pairs either for explicit
+    # task ids or for a task id prefix, as a range scan on the task_id index.
+    query = Task.select(Task.task_id, Task.image_path).where(
+        (Task.status == "completed") & (Task.image_path.is_null(False))
+    )
+    if task_ids is not None:
+        query = query.where(Task.task_id.in_(task_ids))
+    if prefix:
+        upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        query = query.where((Task.task_id >= prefix) & (Task.task_id < upper))
+    if after is not None:
+        query = query.where(Task.task_id > after)
+    return list(query.order_by(Task.task_id).limit(limit).tuples())
+
+
+def set_image_paths(paths: dict[str, str]):
+    # task_id -> new image_path, for images moved to another store
+    for task_id, image_path in paths.items():
+        Task.update(image_path=image_path).where(Task.task_id == task_id).execute()
+    return len(paths)
+
+
+def task_counts():
+    counts = {"pending": 0, "processing": 0, "completed": 0}
+    counts.update({row.status: row.count for row in TaskCount.select()})
+    return counts
+
+
+def queue_summary(counts, completions):
+    # completions maps each stats window in seconds to the tasks completed in it
+    throughput = {f"{window}s": count / window for window, count in completions.items()}
+    remaining = counts["pending"] + counts["processing"]
+    # ETA from the shortest window that saw any completion
+    rate = next((rate for rate in throughput.values() if rate > 0), 0)
+    eta = remaining / rate if rate else None
+    total = sum(counts.values())
+    return {
+        "counts": counts,
+        "total": total,
+        "progress": counts["completed"] / total if total else 0.0,
+        "throughput": throughput,
+        "eta_seconds": eta,
+    }
+
+
+def completion_counts(windows=STATS_WINDOWS):
+    # Completions per window are an index range count on completed_at. Linked
+    # tasks complete without being generated, they'd inflate the throughput.
+    now = datetime.datetime.now()
+    return {
+        window: Task.select()
+        .where(
+            (Task.completed_at >= now - datetime.timedelta(seconds=window))
+            & Task.linked_from.is_null()
+        )
+        .count()
+        for window in windows
+    }
+
+
+def queue_stats(windows=STATS_WINDOWS):
+    return queue_summary(task_counts(), completion_counts(windows))
+
+
+def percentiles(values, qs=REPORT_PERCENTILES):
+    # Nearest rank, None for phases no task in the window reported
+    values = sorted(value for value in values if value is not None)
+    if not values:
+        return {f"p{q}": None for q in qs}
+    return {f"p{q}": values[min(len(values) - 1, len(values) * q // 100)] for q in qs}
+
+
+def latency_breakdown(rows):
+    return {
+        name: percentiles(row[2 + i] for row in rows)
+        for i, name in enumerate(LATENCY_NAMES)
+    }
+
+
+def completion_summary(rows, window):
+    # rows are (worker_id, attempts, *seconds per LATENCY_NAMES), one per task
+    # completed within the window
+    by_worker = {}
+    for row in rows:
+        by_worker.setdefault(row[0] or "", []).append(row)
+
+    def summary(rows):
+        return {
+            "completed": len(rows),
+            "throughput": len(rows) / window,
+            "retried": sum(1 for row in rows if row[1] > 1),
+            "latency": latency_breakdown(rows),
+        }
+
+    return {
+        "window": window,
+        **summary(rows),
+        "workers": {
+            worker_id: summary(worker_rows)
+            for worker_id, worker_rows in sorted(by_worker.items())
+        },
+    }
+
+
+def seconds_between(start, end):
+    if start is None or end is None:
+        return None
+    return (end - start).total_seconds()
+
+
+def completion_rows(window=3600, now=None):
+    # Tasks generated within the window as completion_summary rows, fetched as
+    # a range scan on the completed_at index
+    now = now or datetime.datetime.now()
+    query = Task.select(
+        Task.worker_id,
+        Task.attempts,
+        Task.created_at,
+        Task.leased_at,
+        Task.completed_at,
+        *(getattr(Task, f"{phase}_seconds") for phase in TIMING_PHASES),
+    ).where(
+        (Task.completed_at >= now - datetime.timedelta(seconds=window))
+        & Task.linked_from.is_null()
+    )
+    return [
+        (
+            worker_id,
+            attempts,
+            seconds_between(created_at, leased_at),
+            seconds_between(leased_at, completed_at),
+            seconds_between(created_at, completed_at),
+            *phases,
+        )
+        for worker_id, attempts, created_at, leased_at, completed_at, *phases in (
+            query.tuples()
+        )
+    ]
+
+
+def completion_report(window=3600, now=None):
+    # Latency percentiles overall and per worker
+    return completion_summary(completion_rows(window, now), window)
+
+
+def migrate_tables(database):
+    # Add columns introduced after the table was first created.
+    if not database.table_exists(Task._meta.table_name):
+        return
+    columns = {column.name for column in database.get_columns(Task._meta.table_name)}
+    migrator = SqliteMigrator(database)
+    if "upload_seconds" in columns and "postprocess_seconds" not in columns:
+        # Was named after the upload it never covered
+        migrate(
+            migrator.rename_column(
+                Task._meta.table_name, "upload_seconds", "postprocess_seconds"
+            )
+        )
+        columns = (columns - {"upload_seconds"}) | {"postprocess_seconds"}
+    operations = [
+        migrator.add_column(Task._meta.table_name, field.column_name, field)
+        for field in Task._meta.sorted_fields
+        if field.column_name not in columns
+    ]
+    if operations:
+        migrate(*operations)
+
+
+def create_counters(database):
+    # Seed the counters from a single GROUP BY the first time they are created,
+    # from then on the triggers keep them current.
+    if not database.table_exists(TaskCount._meta.table_name):
+        database.create_tables([TaskCount])
+        counts = list(
+            Task.select(Task.status, fn.COUNT(Task.id).alias("count"))
+            .group_by(Task.status)
+            .dicts()
+        )
+        if counts:
+            TaskCount.insert_many(counts).execute()
+    for trigger in TASK_COUNT_TRIGGERS:
+        database.execute_sql(trigger)
+
+
+def create_tables(database=None):
+    # Shards pass their own database, the models are bound to it meanwhile
+    database = database if database is not None else database_proxy.obj
+    with database.bind_ctx(MODELS), database:
+        migrate_tables(database)
+        database.create_tables([Task], safe=True)
+        create_counters(database)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,119 @@
+import asyncio
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+
+from . import metrics
+
+
+def _resolve(future: asyncio.Future, ok: bool, value):
+    if future.cancelled():
+        return
+    if ok:
+        future.set_result(value)
+    else:
+        future.set_exception(value)
+
+
+class DBExecutor:
+    # Runs database calls off the event loop.
+    # Writes go to one dedicated thread. Every call that queued up while the
+    # previous transaction was running is executed in the next one (group
+    # commit), each inside its own savepoint so a failing call only rolls back
+    # itself. Results are handed back after the commit.
+    # Reads run on a small thread pool with their own connections, which WAL
+    # lets proceed next to the writer.
+    # `models` are bound to `database` in every thread of the executor, see
+    # db.BaseModel.
+    def __init__(self, database, max_batch=256, readers=4, models=(), name="dig-db"):
+        self.database = database
+        self.name = name
+        self.max_batch = max_batch
+        self.num_readers = readers
+        self.models = list(models)
+        self.queue = queue.SimpleQueue()
+        self.thread = None
+        self.readers = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self.thread.start()
+        self.readers = ThreadPoolExecutor(
+            self.num_readers,
+            thread_name_prefix=f"{self.name}-read",
+            initializer=self.bind,
+        )
+
+    def stop(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        if self.readers is not None:
+            self.readers.shutdown()
+            self.readers = None
+
+    def bind(self):
+        if self.models:
+            self.database.bind(self.models, bind_refs=False, bind_backrefs=False)
+
+    async def run(self, fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.queue.put((fn, args, kwargs, loop, future))
+        return await future
+
+    async def read(self, fn, *args, **kwargs):
+        def call():
+            t0 = perf_counter()
+            try:
+                with self.database.atomic():
+                    return fn(*args, **kwargs)
+            finally:
+                metrics.DB_READ_SECONDS.observe(perf_counter() - t0)
+
+        return await asyncio.get_running_loop().run_in_executor(self.readers, call)
+
+    def _run(self):
+        self.bind()
+        self.database.connect(reuse_if_open=True)
+        try:
+            running = True
+            while running:
+                item = self.queue.get()
+                if item is None:
+                    break
+                batch = [item]
+                while len(batch) < self.max_batch:
+                    try:
+                        item = self.queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is None:
+                        running = False
+                        break
+                    batch.append(item)
+                self._run_batch(batch)
+        finally:
+            if not self.database.is_closed():
+                self.database.close()
+
+    def _run_batch(self, batch):
+        results = []
+        t0 = perf_counter()
+        try:
+            with self.database.atomic():
+                for fn, args, kwargs, _, _ in batch:
+                    try:
+                        with self.database.atomic():
+                            results.append((True, fn(*args, **kwargs)))
+                    except Exception as e:
+                        results.append((False, e))
+        except Exception as e:
+            # The commit itself failed, so did every call in the batch
+            results = [(False, e)] * len(batch)
+        metrics.DB_TRANSACTION_SECONDS.observe(perf_counter() - t0)
+        metrics.DB_BATCH_CALLS.observe(len(batch))
+        for (_, _, _, loop, future), (ok, value) in zip(batch, results):
+            loop.call_soon_threadsafe(_resolve, future, ok, value)
@@ -0,0 +1,344 @@
+import os
+import io
+import sys
+import json
+import random
+import shutil
+import socket
+import asyncio
+import argparse
+import tempfile
+import subprocess
+from collections import defaultdict
+from time import perf_counter
+
+import httpx
+from PIL import Image
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def fake_webp(size=64):
+    image = Image.effect_noise((size, size), 64).convert("RGB")
+    buffer = io.BytesIO()
+    image.save(buffer, format="WEBP", quality=90)
+    return buffer.getvalue()
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class LoadStats:
+    # Latencies and status codes per endpoint
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.statuses = defaultdict(lambda: defaultdict(int))
+        self.errors = defaultdict(int)
+        self.start = perf_counter()
+        self.end = None
+
+    async def call(self, endpoint, request):
+        t0 = perf_counter()
+        try:
+            response = await request
+        except httpx.HTTPError as e:
+            self.errors[endpoint] += 1
+            print(f"{endpoint}: {e!r}")
+            return None
+        self.latencies[endpoint].append(perf_counter() - t0)
+        self.statuses[endpoint][response.status_code] += 1
+        return response
+
+    def report(self):
+        elapsed = (self.end or perf_counter()) - self.start
+        endpoints = {}
+        for endpoint, latencies in sorted(self.latencies.items()):
+            endpoints[endpoint] = {
+                "requests": len(latencies),
+                "rps": len(latencies) / elapsed,
+                "p50_ms": percentile(latencies, 0.5) * 1000,
+                "p99_ms": percentile(latencies, 0.99) * 1000,
+                "statuses": dict(self.statuses[endpoint]),
+                "errors": self.errors[endpoint],
+            }
+        return {
+            "elapsed_s": elapsed,
+            "endpoints": endpoints,
+            # Lease and complete conflicts, SQLite lock contention shows up here
+            "conflicts": sum(
+                statuses.get(409, 0) for statuses in self.statuses.values()
+            ),
+            "errors": sum(self.errors.values()),
+        }
+
+
+async def submitter(client, stats, index, interval, deadline):
+    count = 0
+    while perf_counter() < deadline:
+        await stats.call(
+            "POST /request",
+            client.post(
+                "/request",
+                json={
+                    "prompt": f"load test prompt {index} {count}",
+                    "extra_args": {"task_id": f"load-{index}-{count}"},
+                },
+            ),
+        )
+        count += 1
+        if interval:
+            await asyncio.sleep(interval)
+
+
+async def lease_single(client, stats, worker_id, batch_size):
+    # A batch assembled from /task calls, like a worker with BATCH_LEASE off
+    tasks = []
+    while len(tasks) < batch_size:
+        response = await stats.call(
+            "GET /task", client.get("/task", params={"worker_id": worker_id})
+        )
+        if response is None or response.status_code != 200:
+            break
+        tasks.append(response.json())
+    return tasks
+
+
+async def worker(
+    client,
+    stats,
+    index,
+    batch_size,
+    sample_time,
+    payload,
+    completed,
+    deadline,
+    single=False,
+):
+    worker_id = f"load-worker-{index}"
+    while perf_counter() < deadline:
+        if single:
+            tasks = await lease_single(client, stats, worker_id, batch_size)
+        else:
+            response = await stats.call(
+                "GET /tasks",
+                client.get(
+                    "/tasks", params={"limit": batch_size, "worker_id": worker_id}
+                ),
+            )
+            tasks = (
+                response.json()
+                if response is not None and response.status_code == 200
+                else []
+            )
+        if not tasks:
+            await asyncio.sleep(0.05)
+            continue
+        # Stands in for the GPU time of a batch
+        if sample_time:
+            await asyncio.sleep(sample_time)
+        for task in tasks:
+            response = await stats.call(
+                "POST /complete",
+                client.post(
+                    f"/complete/{task['task_id']}",
+                    files={"image": ("image.webp", payload, "image/webp")},
+                ),
+            )
+            if response is not None and response.status_code == 200:
+                completed.append(task["task_id"])
+
+
+async def downloader(client, stats, completed, deadline):
+    while perf_counter() < deadline:
+        if not completed:
+            await asyncio.sleep(0.05)
+            continue
+        task_id = random.choice(completed)
+        await stats.call("GET /download", client.get(f"/download/{task_id}"))
+
+
+async def run_load(
+    url,
+    duration=10,
+    submitters=4,
+    workers=8,
+    downloaders=2,
+    batch_size=16,
+    submit_interval=0.0,
+    sample_time=0.0,
+    image_size=64,
+    single_workers=0,
+):
+    # The first `single_workers` workers lease through /task, the rest /tasks
+    stats = LoadStats()
+    payload = fake_webp(image_size)
+    completed = []
+    deadline = perf_counter() + duration
+    limits = httpx.Limits(max_connections=submitters + workers + downloaders)
+    async with httpx.AsyncClient(base_url=url, timeout=60, limits=limits) as client:
+        actors = [
+            submitter(client, stats, i, submit_interval, deadline)
+            for i in range(submitters)
+        ]
+        actors += [
+            worker(
+                client,
+                stats,
+                i,
+                batch_size,
+                sample_time,
+                payload,
+                completed,
+                deadline,
+                single=i < single_workers,
+            )
+            for i in range(workers)
+        ]
+        actors += [
+            downloader(client, stats, completed, deadline) for _ in range(downloaders)
+        ]
+        await asyncio.gather(*actors)
+        stats.end = perf_counter()
+        response = await client.get("/stats")
+    report = stats.report()
+    report["queue"] = response.json()["counts"]
+    return report
+
+
+def start_server(workdir, port, env=None):
+    # The app runs in its own process against a fresh DB, so the load generator
+    # doesn't compete with it for the GIL
+    os.makedirs(os.path.join(workdir, "db"), exist_ok=True)
+    os.makedirs(os.path.join(workdir, "images"), exist_ok=True)
+    package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    server_env = {
+        **os.environ,
+        "DB_PATH": os.path.join(workdir, "db", "image_tasks.db"),
+        "QUEUE_DIR": os.path.join(workdir, "db", "queue"),
+        "PYTHONPATH": os.pathsep.join([package_dir, os.environ.get("PYTHONPATH", "")]),
+        **(env or {}),
+    }
+    return subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "uvicorn",
+            "dig_server.server:app",
+            "--port",
+            str(port),
+            "--log-level",
+            "warning",
+            "--no-access-log",
+        ],
+        cwd=workdir,
+        env=server_env,
+    )
+
+
+async def wait_ready(url, timeout=30):
+    deadline = perf_counter() + timeout
+    async with httpx.AsyncClient(base_url=url) as client:
+        while perf_counter() < deadline:
+            try:
+                await client.get("/stats")
+                return
+            except httpx.TransportError:
+                await asyncio.sleep(0.1)
+    raise TimeoutError(f"Server at {url} did not start")
+
+
+def print_report(report):
+    print(f"{report['elapsed_s']:.1f}s, queue: {report['queue']}")
+    for endpoint, entry in report["endpoints"].items():
+        print(
+            f"{endpoint:<16} {entry['requests']:>7} req {entry['rps']:>8.1f}/s "
+            f"p50 {entry['p50_ms']:>7.1f}ms p99 {entry['p99_ms']:>7.1f}ms "
+            f"{entry['statuses']}"
+        )
+    print(f"409 conflicts: {report['conflicts']}, errors: {report['errors']}")
+
+
+async def main(args):
+    url = args.url
+    server = None
+    if url is None:
+        port = free_port()
+        url = f"http://127.0.0.1:{port}"
+        workdir = tempfile.mkdtemp(prefix="dig-load-")
+        server = start_server(
+            workdir,
+            port,
+            {"QUEUE_BACKEND": args.backend, "IMAGE_STORE": args.image_store},
+        )
+    try:
+        await wait_ready(url)
+        report = await run_load(
+            url,
+            args.duration,
+            args.submitters,
+            args.workers,
+            args.downloaders,
+            args.batch_size,
+            args.submit_interval,
+            args.sample_time,
+            args.image_size,
+            args.single_workers,
+        )
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+            shutil.rmtree(workdir, ignore_errors=True)
+    print_report(report)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Drive the task server with simulated submitters and workers"
+    )
+    parser.add_argument(
+        "--url", default=None, help="Target a running server instead of a temp one"
+    )
+    parser.add_argument(
+        "--backend",
+        default="sqlite",
+        choices=["sqlite", "memory"],
+        help="QUEUE_BACKEND of the temp server",
+    )
+    parser.add_argument(
+        "--image-store",
+        default="files",
+        choices=["files", "packed"],
+        help="IMAGE_STORE of the temp server",
+    )
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--submitters", type=int, default=4)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument(
+        "--single-workers",
+        type=int,
+        default=2,
+        help="How many of the workers lease one task at a time through /task",
+    )
+    parser.add_argument("--downloaders", type=int, default=2)
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument(
+        "--submit-interval", type=float, default=0.0, help="Seconds between submits"
+    )
+    parser.add_argument(
+        "--sample-time", type=float, default=0.0, help="Simulated seconds per batch"
+    )
+    parser.add_argument("--image-size", type=int, default=64)
+    parser.add_argument("--output", default=None, help="Write the report as JSON")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,743 @@
+import os
+import gc
+import json
+import time
+import heapq
+import pickle
+import bisect
+import threading
+from array import array
+from operator import itemgetter
+from collections import Counter, namedtuple
+from time import perf_counter
+
+from .db import STATS_WINDOWS, TIMING_PHASES, queue_summary, completion_summary
+from .backend import QueueBackend
+
+# Tasks are plain lists indexed by these, the snapshot pickles them as is
+FIELDS = (
+    "task_id",
+    "prompt",
+    "extra_args",
+    "batch_key",
+    "status",
+    "worker_id",
+    "image_path",
+    "created_at",
+    "leased_at",
+    "lease_expires_at",
+    "completed_at",
+    "attempts",
+    "timings",
+    "content_hash",
+    "linked_from",
+)
+(
+    TASK_ID,
+    PROMPT,
+    EXTRA_ARGS,
+    BATCH_KEY,
+    STATUS,
+    WORKER_ID,
+    IMAGE_PATH,
+    CREATED_AT,
+    LEASED_AT,
+    LEASE_EXPIRES_AT,
+    COMPLETED_AT,
+    ATTEMPTS,
+    TIMINGS,
+    CONTENT_HASH,
+    LINKED_FROM,
+    SEQ,
+) = range(len(FIELDS) + 1)
+
+# What get() and lease() hand out, a copy so callers never see later updates
+TaskRecord = namedtuple("TaskRecord", FIELDS)
+
+SNAPSHOT_NAME = "snapshot.pickle"
+WAL_PREFIX = "wal-"
+
+
+def task_record(task) -> TaskRecord:
+    return TaskRecord(*task[:SEQ])
+
+
+class QueueState:
+    # Every task by id, plus one ordering per status:
+    #   pending: a heap of creation sequence numbers per batch key
+    #   processing: a heap of (lease_expires_at, task_id)
+    #   completed: completion times in order, with the matching task ids, of
+    #     generated tasks only so linked ones stay out of the throughput
+    # and by content hash the task handed out or completed with it, plus the
+    # other tasks queued with the hash since, linked once a copy completes.
+    # Those waiting for a pending or processing copy are never leased.
+    # Entries are never removed in place. Ones that no longer match their
+    # task are skipped when they come up and dropped.
+    # Every mutation is deterministic given its arguments, which is what lets
+    # the WAL replay them.
+    def __init__(self):
+        self.tasks = {}
+        self.by_seq = []
+        self.pending = {}
+        self.leases = []
+        self.completed_times = array("d")
+        self.completed_ids = []
+        self.counts = {"pending": 0, "processing": 0, "completed": 0}
+        self.by_hash = {}
+        self.duplicates = {}
+        # Sorted task ids for prefix scans, built on first use
+        self.id_index = None
+        self.new_ids = []
+
+    @classmethod
+    def from_rows(cls, rows, by_hash=None, duplicates=None):
+        # Mostly map/zip over itemgetters, this runs over every task on startup.
+        # by_hash and duplicates hold task ids as written by write_snapshot,
+        # older snapshots without them get them rebuilt from the rows.
+        state = cls()
+        state.by_seq = rows
+        state.tasks = dict(zip(map(itemgetter(TASK_ID), rows), rows))
+        statuses = list(map(itemgetter(STATUS), rows))
+        state.counts.update(Counter(statuses))
+        for task in [t for t, s in zip(rows, statuses) if s == "pending"]:
+            # Appended in sequence order, so every list is already a heap
+            state.pending.setdefault(task[BATCH_KEY], []).append(task[SEQ])
+        state.leases = [
+            (task[LEASE_EXPIRES_AT], task[TASK_ID])
+            for task, status in zip(rows, statuses)
+            if status == "processing"
+        ]
+        heapq.heapify(state.leases)
+        completed = [t for t, s in zip(rows, statuses) if s == "completed"]
+        generated = [task for task in completed if not task[LINKED_FROM]]
+        generated.sort(key=itemgetter(COMPLETED_AT))
+        state.completed_times = array("d", (task[COMPLETED_AT] for task in generated))
+        state.completed_ids = [task[TASK_ID] for task in generated]
+        if by_hash is not None:
+            state.by_hash = {
+                content_hash: state.tasks[task_id]
+                for content_hash, task_id in by_hash.items()
+            }
+            state.duplicates = {
+                content_hash: [state.tasks[task_id] for task_id in task_ids]
+                for content_hash, task_ids in duplicates.items()
+            }
+            return state
+        # The last task generated wins over processing ones, those over the
+        # first pending one with the same hash. Linked tasks are never sources.
+        state.by_hash = {}
+        for task, status in zip(rows, statuses):
+            if status == "pending" and task[CONTENT_HASH]:
+                state.by_hash.setdefault(task[CONTENT_HASH], task)
+        state.by_hash.update(
+            (task[CONTENT_HASH], task)
+            for task, status in zip(rows, statuses)
+            if status == "processing" and task[CONTENT_HASH]
+        )
+        state.by_hash.update(
+            (task[CONTENT_HASH], task) for task in generated if task[CONTENT_HASH]
+        )
+        for task in rows:
+            content_hash = task[CONTENT_HASH]
+            if task[STATUS] == "pending" and content_hash:
+                source = state.by_hash[content_hash]
+                if source is not task and source[STATUS] in ("pending", "processing"):
+                    state.duplicates.setdefault(content_hash, []).append(task)
+        return state
+
+    def apply(self, record):
+        op, *args = record
+        getattr(self, op)(*args)
+
+    def set_status(self, task, status):
+        if task[STATUS] is not None:
+            self.counts[task[STATUS]] -= 1
+        self.counts[status] += 1
+        task[STATUS] = status
+
+    def push_pending(self, task):
+        heapq.heappush(self.pending.setdefault(task[BATCH_KEY], []), task[SEQ])
+
+    def is_pending(self, seq, batch_key):
+        task = self.by_seq[seq]
+        return (
+            task[STATUS] == "pending"
+            and task[BATCH_KEY] == batch_key
+            and not self.waiting(task)
+        )
+
+    def waiting(self, task):
+        # Whether the task waits for the image of an identical one, dropped
+        # from the pending heaps until promote() puts it back
+        source = self.hash_source(task[CONTENT_HASH], ("pending", "processing"))
+        return source is not None and source is not task
+
+    def promote(self, content_hash):
+        # The task duplicates waited for changed, the first one still waiting
+        # takes its place and the rest wait for that one
+        waiting = self.duplicates.pop(content_hash, [])
+        for i, task in enumerate(waiting):
+            if task[STATUS] == "pending" and task[CONTENT_HASH] == content_hash:
+                self.by_hash[content_hash] = task
+                self.push_pending(task)
+                if waiting[i + 1 :]:
+                    self.duplicates[content_hash] = waiting[i + 1 :]
+                return
+
+    def hash_source(self, content_hash, statuses):
+        source = self.by_hash.get(content_hash) if content_hash else None
+        if (
+            source is not None
+            and source[CONTENT_HASH] == content_hash
+            and source[STATUS] in statuses
+        ):
+            return source
+        return None
+
+    def submit(self, rows, now):
+        # Same rules as db.upsert_tasks: unchanged re-submissions are left
+        # alone, requests matching a completed task reuse its image
+        for row in rows:
+            content_hash = row.get("content_hash")
+            task = self.tasks.get(row["task_id"])
+            if task is not None and content_hash and task[CONTENT_HASH] == content_hash:
+                continue
+            if task is None:
+                task = [None] * len(FIELDS) + [len(self.by_seq)]
+                task[TASK_ID] = row["task_id"]
+                task[CREATED_AT] = now
+                self.by_seq.append(task)
+                self.tasks[task[TASK_ID]] = task
+                if self.id_index is not None:
+                    self.new_ids.append(task[TASK_ID])
+            requeue = (
+                task[STATUS] != "pending"
+                or task[BATCH_KEY] != row["batch_key"]
+                or self.waiting(task)
+            )
+            old_hash = task[CONTENT_HASH]
+            task[PROMPT] = row["prompt"]
+            task[EXTRA_ARGS] = row["extra_args"]
+            task[BATCH_KEY] = row["batch_key"]
+            task[CONTENT_HASH] = content_hash
+            task[WORKER_ID] = None
+            task[LEASE_EXPIRES_AT] = None
+            task[ATTEMPTS] = 0
+            task[IMAGE_PATH] = None
+            task[COMPLETED_AT] = None
+            task[LINKED_FROM] = None
+            if old_hash and self.by_hash.get(old_hash) is task:
+                self.promote(old_hash)
+            source = self.hash_source(content_hash, ("completed",))
+            if source is not None and source[IMAGE_PATH]:
+                self.link(task, source, now)
+                continue
+            self.set_status(task, "pending")
+            if requeue:
+                self.push_pending(task)
+            if not content_hash:
+                continue
+            source = self.hash_source(content_hash, ("pending", "processing"))
+            if source is not None and source is not task:
+                self.duplicates.setdefault(content_hash, []).append(task)
+            else:
+                self.by_hash[content_hash] = task
+        return len(rows)
+
+    def oldest_batch_key(self):
+        oldest = None
+        for batch_key, heap in list(self.pending.items()):
+            while heap and not self.is_pending(heap[0], batch_key):
+                heapq.heappop(heap)
+            if not heap:
+                del self.pending[batch_key]
+            elif oldest is None or heap[0] < self.pending[oldest][0]:
+                oldest = batch_key
+        return oldest
+
+    def take_pending(self, limit, batch_key=None):
+        # Pops up to `limit` oldest pending tasks of one batch key, the caller
+        # leases them or pushes them back
+        if batch_key is None:
+            batch_key = self.oldest_batch_key()
+        heap = self.pending.get(batch_key)
+        tasks = []
+        seen = set()
+        while heap and len(tasks) < limit:
+            seq = heapq.heappop(heap)
+            if seq not in seen and self.is_pending(seq, batch_key):
+                seen.add(seq)
+                tasks.append(self.by_seq[seq])
+        if not heap and batch_key in self.pending:
+            del self.pending[batch_key]
+        return tasks
+
+    def lease(self, task_ids, worker_id, expires, now):
+        for task_id in task_ids:
+            task = self.tasks[task_id]
+            self.set_status(task, "processing")
+            task[WORKER_ID] = worker_id
+            task[LEASED_AT] = now
+            task[LEASE_EXPIRES_AT] = expires
+            task[ATTEMPTS] += 1
+            heapq.heappush(self.leases, (expires, task_id))
+
+    def held(self, worker_id, task_ids):
+        return [
+            task_id
+            for task_id in task_ids
+            if (task := self.tasks.get(task_id)) is not None
+            and task[STATUS] == "processing"
+            and task[WORKER_ID] == worker_id
+        ]
+
+    def extend(self, worker_id, task_ids, expires):
+        for task_id in self.held(worker_id, task_ids):
+            self.tasks[task_id][LEASE_EXPIRES_AT] = expires
+            heapq.heappush(self.leases, (expires, task_id))
+
+    def reset(self, task_ids):
+        count = 0
+        for task_id in task_ids:
+            task = self.tasks.get(task_id)
+            if task is None:
+                continue
+            count += 1
+            requeue = task[STATUS] != "pending"
+            task[WORKER_ID] = None
+            task[LEASE_EXPIRES_AT] = None
+            task[LINKED_FROM] = None
+            self.set_status(task, "pending")
+            if not requeue:
+                continue
+            content_hash = task[CONTENT_HASH]
+            if content_hash and self.by_hash.get(content_hash) is not task:
+                # Another task has this hash, complete() links this one when
+                # that one or any other copy completes
+                self.duplicates.setdefault(content_hash, []).append(task)
+            if not self.waiting(task):
+                self.push_pending(task)
+        return count
+
+    def expired(self, now):
+        # Pops the leases that ran out, the caller resets them
+        task_ids = []
+        while self.leases and self.leases[0][0] < now:
+            expires, task_id = heapq.heappop(self.leases)
+            task = self.tasks[task_id]
+            if task[STATUS] == "processing" and task[LEASE_EXPIRES_AT] == expires:
+                task_ids.append(task_id)
+        return task_ids
+
+    def can_complete(self, task_id):
+        task = self.tasks.get(task_id)
+        return task is not None and task[STATUS] == "processing"
+
+    def complete(self, task_id, image_path, now, timings=None):
+        if not self.can_complete(task_id):
+            return 0
+        task = self.tasks[task_id]
+        task[IMAGE_PATH] = image_path
+        task[LINKED_FROM] = None
+        task[TIMINGS] = (
+            tuple(timings.get(phase) for phase in TIMING_PHASES) if timings else None
+        )
+        self.mark_completed(task, now)
+        # Kept sorted for bisect even if the wall clock steps back
+        self.completed_times.append(
+            max(now, self.completed_times[-1]) if self.completed_times else now
+        )
+        self.completed_ids.append(task_id)
+        content_hash = task[CONTENT_HASH]
+        if content_hash:
+            # Every other pending task with the hash is either the one it was
+            # handed out for or in its duplicates, they all get this image
+            linked = self.duplicates.pop(content_hash, [])
+            source = self.hash_source(content_hash, ("pending",))
+            if source is not None:
+                linked.append(source)
+            self.by_hash[content_hash] = task
+            for duplicate in linked:
+                if (
+                    duplicate[STATUS] == "pending"
+                    and duplicate[CONTENT_HASH] == content_hash
+                ):
+                    self.link(duplicate, task, now)
+        return 1
+
+    def link(self, task, source, now):
+        task[IMAGE_PATH] = source[IMAGE_PATH]
+        task[LINKED_FROM] = source[TASK_ID]
+        task[WORKER_ID] = None
+        self.mark_completed(task, now)
+
+    def mark_completed(self, task, now):
+        self.set_status(task, "completed")
+        task[LEASE_EXPIRES_AT] = None
+        task[COMPLETED_AT] = now
+
+    def recent_completions(self, since):
+        # Task ids completed since `since`, only the latest completion counts
+        start = bisect.bisect_left(self.completed_times, since)
+        for i in range(start, len(self.completed_ids)):
+            task = self.tasks[self.completed_ids[i]]
+            if (
+                task[STATUS] == "completed"
+                and task[COMPLETED_AT] >= since
+                and not task[LINKED_FROM]
+            ):
+                yield task
+
+    def completions_since(self, since):
+        return len(self.completed_times) - bisect.bisect_left(
+            self.completed_times, since
+        )
+
+    def completion_rows(self, since):
+        rows = []
+        for task in self.recent_completions(since):
+            leased_at = task[LEASED_AT]
+            rows.append(
+                (
+                    task[WORKER_ID],
+                    task[ATTEMPTS],
+                    leased_at - task[CREATED_AT] if leased_at else None,
+                    task[COMPLETED_AT] - leased_at if leased_at else None,
+                    task[COMPLETED_AT] - task[CREATED_AT],
+                    *(task[TIMINGS] or (None,) * len(TIMING_PHASES)),
+                )
+            )
+        return rows
+
+    def sorted_ids(self):
+        if self.id_index is None:
+            self.id_index = sorted(self.tasks)
+            self.new_ids = []
+        elif self.new_ids:
+            # Appending a sorted run and re-sorting is a single merge
+            self.id_index.extend(sorted(self.new_ids))
+            self.id_index.sort()
+            self.new_ids = []
+        return self.id_index
+
+    def completed_images(self, task_ids=None, prefix=None, after=None, limit=1000):
+        # Same pages as db.completed_images, ordered by task id
+        if task_ids is not None:
+            candidates = sorted(set(task_ids))
+        else:
+            candidates = self.sorted_ids()
+        start = bisect.bisect_left(candidates, prefix) if prefix else 0
+        if after is not None:
+            start = max(start, bisect.bisect_right(candidates, after))
+        images = []
+        for i in range(start, len(candidates)):
+            task_id = candidates[i]
+            if prefix and not task_id.startswith(prefix):
+                break
+            task = self.tasks.get(task_id)
+            if task is None or task[STATUS] != "completed" or not task[IMAGE_PATH]:
+                continue
+            images.append((task_id, task[IMAGE_PATH]))
+            if len(images) >= limit:
+                break
+        return images
+
+    def set_image_paths(self, paths):
+        for task_id, image_path in paths.items():
+            task = self.tasks.get(task_id)
+            if task is not None:
+                task[IMAGE_PATH] = image_path
+        return len(paths)
+
+
+def wal_files(directory):
+    # (generation, path) of every WAL file, oldest first
+    files = []
+    for name in os.listdir(directory):
+        if name.startswith(WAL_PREFIX) and name.endswith(".jsonl"):
+            generation = int(name[len(WAL_PREFIX) : -len(".jsonl")])
+            files.append((generation, os.path.join(directory, name)))
+    return sorted(files)
+
+
+def replay_wal(state: QueueState, path: str) -> int:
+    count = 0
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # A torn last record from a crash mid-write, the rest is intact
+                print(f"Ignoring a partial record at the end of {path}")
+                break
+            state.apply(record)
+            count += 1
+    return count
+
+
+def upgrade_rows(rows, fields):
+    # Snapshots written before fields were added get them as None
+    fields = tuple(fields)
+    if fields == FIELDS:
+        return rows
+    index = {name: i for i, name in enumerate(fields)}
+    return [
+        [row[index[name]] if name in index else None for name in FIELDS]
+        + [row[len(fields)]]
+        for row in rows
+    ]
+
+
+def load_snapshot(directory):
+    path = os.path.join(directory, SNAPSHOT_NAME)
+    if not os.path.exists(path):
+        return QueueState(), 0
+    # Millions of new lists would trigger collections that find nothing to
+    # free, and once loaded they are long lived, so keep them out of later
+    # full collections too
+    gc.disable()
+    try:
+        with open(path, "rb") as f:
+            snapshot = pickle.load(f)
+        state = QueueState.from_rows(
+            upgrade_rows(snapshot["tasks"], snapshot.get("fields", FIELDS[:13])),
+            snapshot.get("by_hash"),
+            snapshot.get("duplicates"),
+        )
+    finally:
+        gc.enable()
+    gc.freeze()
+    return state, snapshot["generation"]
+
+
+def write_snapshot(directory, state: QueueState, generation: int):
+    # The snapshot covers every WAL file before `generation`
+    path = os.path.join(directory, SNAPSHOT_NAME)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump(
+            {
+                "generation": generation,
+                "fields": FIELDS,
+                "tasks": state.by_seq,
+                # Which task each hash links to depends on the order of past
+                # completions, the rows alone don't tell
+                "by_hash": {
+                    content_hash: task[TASK_ID]
+                    for content_hash, task in state.by_hash.items()
+                },
+                "duplicates": {
+                    content_hash: [task[TASK_ID] for task in tasks]
+                    for content_hash, tasks in state.duplicates.items()
+                },
+            },
+            f,
+            protocol=pickle.HIGHEST_PROTOCOL,
+        )
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    for wal_generation, wal_path in wal_files(directory):
+        if wal_generation < generation:
+            os.remove(wal_path)
+
+
+def compact(directory, generation):
+    # Folds the WAL files before `generation` into the snapshot. Works on its
+    # own copy of the state so the live queue keeps serving meanwhile.
+    t0 = perf_counter()
+    state, start = load_snapshot(directory)
+    for wal_generation, wal_path in wal_files(directory):
+        if start <= wal_generation < generation:
+            replay_wal(state, wal_path)
+    write_snapshot(directory, state, generation)
+    print(
+        f"Compacted the queue WAL into a snapshot of {len(state.tasks)} tasks "
+        f"in {perf_counter() - t0:.2f}s"
+    )
+
+
+class MemoryBackend(QueueBackend):
+    # Keeps the whole queue in memory (see QueueState) so leases and
+    # completions are a few dict and heap operations on the event loop.
+    # Every mutation is first appended to a write-ahead log, flushed to the OS
+    # right away and fsynced every `sync_interval` seconds. After
+    # `snapshot_every` records the log is rotated and folded into a pickled
+    # snapshot in the background. Startup loads the snapshot and replays the
+    # newer logs. One server process owns the directory.
+    def __init__(
+        self, directory="db/queue", snapshot_every=1_000_000, sync_interval=1.0
+    ):
+        self.directory = directory
+        self.snapshot_every = snapshot_every
+        self.sync_interval = sync_interval
+        self.state = QueueState()
+        self.generation = 0
+        self.wal = None
+        self.wal_records = 0
+        self.wal_lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.syncer = None
+        self.compactor = None
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        t0 = perf_counter()
+        self.state, self.generation = load_snapshot(self.directory)
+        replayed = 0
+        for generation, path in wal_files(self.directory):
+            if generation < self.generation:
+                # Already folded into the snapshot
+                os.remove(path)
+                continue
+            replayed += replay_wal(self.state, path)
+            self.generation = generation + 1
+        # Replayed records stay in their files until the next compaction
+        self.wal_records = replayed
+        self.open_wal()
+        print(
+            f"Loaded {len(self.state.tasks)} tasks and replayed {replayed} WAL "
+            f"records in {perf_counter() - t0:.2f}s"
+        )
+        self.stopping.clear()
+        self.syncer = threading.Thread(
+            target=self.sync_loop, name="dig-wal-sync", daemon=True
+        )
+        self.syncer.start()
+
+    def stop(self):
+        self.stopping.set()
+        if self.syncer is not None:
+            self.syncer.join()
+            self.syncer = None
+        if self.compactor is not None:
+            self.compactor.join()
+            self.compactor = None
+        if self.wal is None:
+            return
+        self.close_wal()
+        # Nothing else runs now, so the live state can be written as is
+        self.generation += 1
+        write_snapshot(self.directory, self.state, self.generation)
+
+    def wal_path(self, generation):
+        return os.path.join(self.directory, f"{WAL_PREFIX}{generation:08d}.jsonl")
+
+    def open_wal(self):
+        self.wal = open(self.wal_path(self.generation), "a", encoding="utf-8")
+
+    def close_wal(self):
+        with self.wal_lock:
+            self.wal.flush()
+            os.fsync(self.wal.fileno())
+            self.wal.close()
+            self.wal = None
+
+    def sync_loop(self):
+        while not self.stopping.wait(self.sync_interval):
+            with self.wal_lock:
+                if self.wal is not None:
+                    os.fsync(self.wal.fileno())
+
+    def log(self, *record):
+        self.wal.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.wal.flush()
+        self.wal_records += 1
+        if self.wal_records >= self.snapshot_every and (
+            self.compactor is None or not self.compactor.is_alive()
+        ):
+            self.rotate()
+
+    def rotate(self):
+        self.close_wal()
+        self.generation += 1
+        self.open_wal()
+        self.wal_records = 0
+        self.compactor = threading.Thread(
+            target=compact,
+            args=(self.directory, self.generation),
+            name="dig-wal-compact",
+            daemon=True,
+        )
+        self.compactor.start()
+
+    async def submit(self, rows):
+        now = time.time()
+        self.log("submit", rows, now)
+        return self.state.submit(rows, now)
+
+    async def lease(self, limit, worker_id, lease_seconds, batch_key=None):
+        tasks = self.state.take_pending(limit, batch_key)
+        if not tasks:
+            return []
+        now = time.time()
+        expires = now + lease_seconds
+        task_ids = [task[TASK_ID] for task in tasks]
+        try:
+            self.log("lease", task_ids, worker_id, expires, now)
+        except Exception:
+            for task in tasks:
+                self.state.push_pending(task)
+            raise
+        self.state.lease(task_ids, worker_id, expires, now)
+        return [task_record(task) for task in tasks]
+
+    async def extend_leases(self, worker_id, task_ids, lease_seconds):
+        held = self.state.held(worker_id, task_ids)
+        if held:
+            expires = time.time() + lease_seconds
+            self.log("extend", worker_id, held, expires)
+            self.state.extend(worker_id, held, expires)
+        return held
+
+    async def reset(self, task_ids):
+        self.log("reset", task_ids)
+        return self.state.reset(task_ids)
+
+    async def complete(self, task_id, image_path, timings=None):
+        if not self.state.can_complete(task_id):
+            return 0
+        now = time.time()
+        self.log("complete", task_id, image_path, now, timings)
+        return self.state.complete(task_id, image_path, now, timings)
+
+    async def reclaim_expired(self):
+        task_ids = self.state.expired(time.time())
+        if not task_ids:
+            return 0
+        try:
+            self.log("reset", task_ids)
+        except Exception:
+            for task_id in task_ids:
+                task = self.state.tasks[task_id]
+                heapq.heappush(self.state.leases, (task[LEASE_EXPIRES_AT], task_id))
+            raise
+        return self.state.reset(task_ids)
+
+    async def get(self, task_id):
+        task = self.state.tasks.get(task_id)
+        return task_record(task) if task is not None else None
+
+    async def task_counts(self):
+        return dict(self.state.counts)
+
+    async def queue_stats(self):
+        now = time.time()
+        completions = {
+            window: self.state.completions_since(now - window)
+            for window in STATS_WINDOWS
+        }
+        return queue_summary(dict(self.state.counts), completions)
+
+    async def completion_report(self, window):
+        rows = self.state.completion_rows(time.time() - window)
+        return completion_summary(rows, window)
+
+    async def completed_images(
+        self, task_ids=None, prefix=None, after=None, limit=1000
+    ):
+        return self.state.completed_images(task_ids, prefix, after, limit)
+
+    async def set_image_paths(self, paths):
+        self.log("set_image_paths", paths)
+        return self.state.set_image_paths(paths)
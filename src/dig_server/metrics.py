@@ -0,0 +1,175 @@
+import math
+import bisect
+import threading
+
+# Seconds, from sub-millisecond DB calls up to long-polled leases
+DEFAULT_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+    60,
+    120,
+)
+
+
+def format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def format_labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ""
+    escaped = (
+        (
+            name,
+            str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"),
+        )
+        for name, value in pairs
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+class Metric:
+    # Base for the metric types below. Values are keyed by label values and
+    # guarded by a lock, the DB thread and the event loop both update them.
+    type = None
+
+    def __init__(self, name: str, help: str, labels=(), registry=None):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+        (registry if registry is not None else REGISTRY).append(self)
+
+    def key(self, labels: dict):
+        return tuple(labels.get(name, "") for name in self.labels)
+
+    def samples(self):
+        with self.lock:
+            return [
+                (self.name, key, (), value)
+                for key, value in sorted(self.values.items())
+            ]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        for name, key, extra, value in self.samples():
+            labels = format_labels(self.labels, key, extra)
+            lines.append(f"{name}{labels} {format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value: float, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS, registry=None):
+        super().__init__(name, help, labels, registry)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value: float, **labels):
+        key = self.key(labels)
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+            entry[0][bisect.bisect_left(self.buckets, value)] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            for key, (counts, total, count) in sorted(self.values.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    samples.append(
+                        (
+                            f"{self.name}_bucket",
+                            key,
+                            (("le", format_value(bound)),),
+                            cumulative,
+                        )
+                    )
+                samples.append((f"{self.name}_sum", key, (), total))
+                samples.append((f"{self.name}_count", key, (), count))
+        return samples
+
+
+REGISTRY = []
+
+
+def render(registry=None) -> str:
+    # Text exposition format, what Prometheus scrapes from /metrics
+    metrics = registry if registry is not None else REGISTRY
+    return "\n".join(metric.render() for metric in metrics) + "\n"
+
+
+REQUESTS = Counter(
+    "dig_http_requests_total",
+    "HTTP requests by route and status",
+    ("method", "route", "status"),
+)
+REQUEST_SECONDS = Histogram(
+    "dig_http_request_seconds",
+    "Time to the response headers by route",
+    ("method", "route"),
+)
+LEASE_LATENCY = Histogram(
+    "dig_lease_seconds",
+    "Time to answer a lease request, long-poll waits included",
+)
+LEASED_TASKS = Counter("dig_leased_tasks_total", "Tasks handed out to workers")
+DB_TRANSACTION_SECONDS = Histogram(
+    "dig_db_transaction_seconds",
+    "Duration of group-committed write transactions",
+)
+DB_BATCH_CALLS = Histogram(
+    "dig_db_batch_calls",
+    "Calls committed per write transaction",
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 512),
+)
+DB_READ_SECONDS = Histogram("dig_db_read_seconds", "Duration of read transactions")
+UPLOAD_BYTES = Counter("dig_upload_bytes_total", "Bytes of completed images received")
+UPLOAD_SECONDS = Histogram(
+    "dig_upload_seconds", "Time to store an uploaded image on disk"
+)
+QUEUE_TASKS = Gauge("dig_queue_tasks", "Tasks by status", ("status",))
+ACTIVE_WORKERS = Gauge(
+    "dig_active_workers", "Workers that leased or heartbeated recently"
+)
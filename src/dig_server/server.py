@@ -1,17 +1,68 @@
 import os
 import json
-import io
+import hashlib
+import asyncio
+import tarfile
+from email.utils import formatdate, parsedate_to_datetime
+from time import perf_counter
 from uuid import uuid4
 from contextlib import asynccontextmanager
 from typing import Optional
 
 from PIL import Image
-from pydantic import BaseModel, Field
-from peewee import fn, SqliteDatabase, IntegrityError
-from fastapi import FastAPI, HTTPException, UploadFile, File, Depends
-from fastapi.responses import Response
-
-from .db import database_proxy, Task, initialize_db
+from pydantic import AliasChoices, BaseModel, Field, ValidationError, field_validator
+from peewee import IntegrityError, OperationalError
+from fastapi import FastAPI, HTTPException, UploadFile, File, Form, Query, Request
+from fastapi.responses import (
+    Response,
+    FileResponse,
+    StreamingResponse,
+    PlainTextResponse,
+)
+
+from .db import batch_key, content_hash
+from .backend import QueueBackend, SqliteBackend, ShardedSqliteBackend
+from .memqueue import MemoryBackend
+from .storage import ImageStore, FileStore, PackedStore, tar_header, tar_padding
+from . import metrics
+
+LEASE_SECONDS = int(os.environ.get("LEASE_SECONDS", 300))
+REAPER_INTERVAL = float(os.environ.get("REAPER_INTERVAL", 30))
+SUBMIT_CHUNK_SIZE = 500
+DB_MAX_BATCH = int(os.environ.get("DB_MAX_BATCH", 256))
+DB_READERS = int(os.environ.get("DB_READERS", 4))
+# With more than one shard the sqlite backend spreads tasks over DB_SHARDS
+# files next to DB_PATH, see ShardedSqliteBackend
+DB_SHARDS = int(os.environ.get("DB_SHARDS", 1))
+# "sqlite" for the peewee Task table, "memory" for the in-memory queue with a
+# write-ahead log in QUEUE_DIR (one server process only)
+QUEUE_BACKEND = os.environ.get("QUEUE_BACKEND", "sqlite")
+QUEUE_DIR = os.environ.get("QUEUE_DIR", "db/queue")
+QUEUE_SNAPSHOT_EVERY = int(os.environ.get("QUEUE_SNAPSHOT_EVERY", 1_000_000))
+QUEUE_SYNC_INTERVAL = float(os.environ.get("QUEUE_SYNC_INTERVAL", 1.0))
+# "files" for one file per image under IMAGE_DIR, spread over IMAGE_FANOUT
+# levels of hashed subdirectories, "packed" to append images to tar files of
+# up to PACK_SIZE bytes in IMAGE_DIR/packs
+IMAGE_STORE = os.environ.get("IMAGE_STORE", "files")
+IMAGE_DIR = os.environ.get("IMAGE_DIR", "images")
+IMAGE_FANOUT = int(os.environ.get("IMAGE_FANOUT", 2))
+PACK_SIZE = int(os.environ.get("PACK_SIZE", 1 << 30))
+MAX_LEASE_WAIT = 120
+# Long-polls also re-check the queue this often, to pick up work queued by
+# other server processes which can't wake our waiters
+LEASE_RECHECK_INTERVAL = float(os.environ.get("LEASE_RECHECK_INTERVAL", 5))
+# Uploads are stored as sent. Set a quality to decode and re-encode them instead.
+REENCODE_QUALITY = os.environ.get("REENCODE_QUALITY")
+REENCODE_QUALITY = int(REENCODE_QUALITY) if REENCODE_QUALITY else None
+# Names the worker knows, see dig_client.diff.SAMPLERS and SCHEDULES
+SAMPLERS = ("euler", "euler_ancestral", "dpmpp_2m", "dpmpp_2m_sde")
+SCHEDULES = ("exponential", "polyexponential", "linear")
+MAX_STEPS = 200
+# The UNet downsamples by 64 in total
+SIZE_MULTIPLE = 64
+# Part of every task's content hash, set it when the workers change model so
+# old images aren't reused for new requests
+MODEL_NAME = os.environ.get("MODEL_NAME", "")
 
 
 class PromptRequest(BaseModel):
@@ -20,134 +71,537 @@ class PromptRequest(BaseModel):
         default_factory=dict
     )
 
+    @field_validator("extra_args")
+    @classmethod
+    def check_sampling_args(cls, extra_args):
+        # Reject unknown names here instead of failing the whole batch later
+        if extra_args is None:
+            return extra_args
+        if extra_args.get("sampler", SAMPLERS[0]) not in SAMPLERS:
+            raise ValueError(f"sampler must be one of {list(SAMPLERS)}")
+        if extra_args.get("schedule", SCHEDULES[0]) not in SCHEDULES:
+            raise ValueError(f"schedule must be one of {list(SCHEDULES)}")
+        steps = extra_args.get("steps", 1)
+        if not isinstance(steps, int) or not 1 <= steps <= MAX_STEPS:
+            raise ValueError(f"steps must be between 1 and {MAX_STEPS}")
+        for name in ("width", "height"):
+            size = extra_args.get(name, SIZE_MULTIPLE)
+            if (
+                not isinstance(size, int)
+                or isinstance(size, bool)
+                or size <= 0
+                or size % SIZE_MULTIPLE
+            ):
+                raise ValueError(
+                    f"{name} must be a positive multiple of {SIZE_MULTIPLE}"
+                )
+        guidance_scale = extra_args.get("guidance_scale", 0)
+        if not isinstance(guidance_scale, (int, float)) or isinstance(
+            guidance_scale, bool
+        ):
+            raise ValueError("guidance_scale must be a number")
+        return extra_args
+
+    @field_validator("extra_args")
+    @classmethod
+    def check_seed(cls, extra_args):
+        # The worker takes the seed modulo 2**32, digit strings are converted
+        for name in ("seed", "seeds"):
+            if extra_args is None or name not in extra_args:
+                continue
+            seed = extra_args[name]
+            if isinstance(seed, str) and seed.strip().lstrip("-").isdigit():
+                seed = int(seed)
+            if not isinstance(seed, int) or isinstance(seed, bool):
+                raise ValueError(f"{name} must be an integer")
+            extra_args[name] = seed
+        return extra_args
+
 
 class TaskResponse(BaseModel):
     task_id: str
 
 
+class BulkTaskResponse(BaseModel):
+    task_ids: list[str]
+
+
 class TaskRequest(BaseModel):
     task_id: str
     prompt: str
     extra_args: dict[str, int | float | str | bool] = Field(default_factory=dict)
 
 
-def get_db():
-    db = database_proxy.obj
-    db.connect(reuse_if_open=True)
-    try:
-        yield db
-    finally:
-        if not db.is_closed():
-            db.close()
+class QueueStats(BaseModel):
+    counts: dict[str, int]
+    total: int
+    progress: float
+    throughput: dict[str, float]
+    eta_seconds: Optional[float]
+    query_ms: float
+
+
+class TaskTimings(BaseModel):
+    # Seconds spent per phase, as measured by the worker
+    encode: Optional[float] = Field(None, ge=0)
+    sample: Optional[float] = Field(None, ge=0)
+    decode: Optional[float] = Field(None, ge=0)
+    # Older workers send it as "upload"
+    postprocess: Optional[float] = Field(
+        None, ge=0, validation_alias=AliasChoices("postprocess", "upload")
+    )
+
+
+class WorkerReport(BaseModel):
+    completed: int
+    throughput: float
+    retried: int
+    latency: dict[str, dict[str, Optional[float]]]
+
+
+class CompletionReport(WorkerReport):
+    window: int
+    workers: dict[str, WorkerReport]
+    query_ms: float
+
+
+class ArchiveRequest(BaseModel):
+    task_ids: list[str]
+
+
+class HeartbeatRequest(BaseModel):
+    worker_id: str
+    task_ids: list[str]
+    lease: Optional[int] = None
+
+
+class HeartbeatResponse(BaseModel):
+    task_ids: list[str]
+
+
+class TaskNotifier:
+    # Wakes long-polling lease requests as soon as new work is queued
+    def __init__(self):
+        self.event = asyncio.Event()
+
+    def notify(self):
+        self.event.set()
+        self.event = asyncio.Event()
+
+    async def wait(self, event: asyncio.Event, timeout: float):
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+
+def create_backend(name: str = QUEUE_BACKEND) -> QueueBackend:
+    if name == "sqlite":
+        db_path = os.environ.get("DB_PATH", "db/image_tasks.db")
+        if DB_SHARDS > 1:
+            return ShardedSqliteBackend(
+                db_path,
+                DB_SHARDS,
+                max_batch=DB_MAX_BATCH,
+                readers=max(1, DB_READERS // DB_SHARDS),
+            )
+        return SqliteBackend(db_path, max_batch=DB_MAX_BATCH, readers=DB_READERS)
+    if name == "memory":
+        return MemoryBackend(QUEUE_DIR, QUEUE_SNAPSHOT_EVERY, QUEUE_SYNC_INTERVAL)
+    raise ValueError(f"Unknown QUEUE_BACKEND: {name}")
+
+
+def create_image_store(name: str = IMAGE_STORE) -> ImageStore:
+    if name == "files":
+        return FileStore(IMAGE_DIR, IMAGE_FANOUT)
+    if name == "packed":
+        return PackedStore(f"{IMAGE_DIR}/packs", PACK_SIZE)
+    raise ValueError(f"Unknown IMAGE_STORE: {name}")
+
+
+# All endpoint task access goes through here
+backend = create_backend()
+image_store = create_image_store()
+task_notifier = TaskNotifier()
+# worker_id -> perf_counter() of its last lease or heartbeat
+worker_last_seen = {}
+
+
+def seen_worker(worker_id: Optional[str]):
+    if worker_id:
+        worker_last_seen[worker_id] = perf_counter()
+
+
+def active_workers(window: float = LEASE_SECONDS) -> int:
+    # Workers that leased or heartbeated within one lease period
+    cutoff = perf_counter() - window
+    for worker_id, last_seen in list(worker_last_seen.items()):
+        if last_seen < cutoff:
+            del worker_last_seen[worker_id]
+    return len(worker_last_seen)
+
+
+async def lease_with_wait(
+    limit: int, worker_id: str, lease: int, wait: float, key: Optional[str] = None
+):
+    seen_worker(worker_id)
+    t0 = perf_counter()
+    tasks = await wait_for_tasks(limit, worker_id, lease, wait, key)
+    metrics.LEASE_LATENCY.observe(perf_counter() - t0)
+    metrics.LEASED_TASKS.inc(len(tasks))
+    return tasks
+
+
+async def wait_for_tasks(
+    limit: int, worker_id: str, lease: int, wait: float, key: Optional[str] = None
+):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + wait
+    while True:
+        # Grab the event before querying so a notify in between isn't missed
+        event = task_notifier.event
+        tasks = await backend.lease(limit, worker_id, lease, key)
+        remaining = deadline - loop.time()
+        if tasks or remaining <= 0:
+            return tasks
+        await task_notifier.wait(event, min(remaining, LEASE_RECHECK_INTERVAL))
+
+
+async def reap_expired_leases(interval: float):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            reclaimed = await backend.reclaim_expired()
+            if reclaimed:
+                task_notifier.notify()
+                print(f"Reclaimed {reclaimed} tasks with expired leases")
+        except Exception as e:
+            print(f"Error reclaiming expired leases: {e}")
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup
-    db_path = os.environ.get("DB_PATH", "db/image_tasks.db")
-    initialize_db(db_path)
+    backend.start()
+    image_store.start()
+    # Offline scripts reuse this lifespan with app=None, only the server reaps
+    reaper = None
+    if app is not None and REAPER_INTERVAL > 0:
+        reaper = asyncio.create_task(reap_expired_leases(REAPER_INTERVAL))
     yield
     # Shutdown
-    if not database_proxy.obj.is_closed():
-        database_proxy.obj.close()
+    if reaper is not None:
+        reaper.cancel()
+    image_store.stop()
+    backend.stop()
 
 
 app = FastAPI(lifespan=lifespan)
 
 
-@app.post("/request", response_model=TaskResponse)
-async def create_task(
-    prompt_request: PromptRequest, db: SqliteDatabase = Depends(get_db)
-):
+@app.middleware("http")
+async def count_requests(request: Request, call_next):
+    t0 = perf_counter()
+    response = await call_next(request)
+    # Label by route template, not by path, so task ids don't explode labels
+    route = request.scope.get("route")
+    route = route.path if route is not None else "unmatched"
+    metrics.REQUEST_SECONDS.observe(
+        perf_counter() - t0, method=request.method, route=route
+    )
+    metrics.REQUESTS.inc(
+        method=request.method, route=route, status=response.status_code
+    )
+    return response
+
+
+def task_seed(task_id: str) -> int:
+    # Stable across runs and processes, unlike hash()
+    return int.from_bytes(hashlib.sha256(task_id.encode("utf-8")).digest()[:4], "big")
+
+
+def prompt_request_to_row(prompt_request: PromptRequest) -> dict:
     if "task_id" in prompt_request.extra_args:
         task_id = prompt_request.extra_args.pop("task_id")
     else:
         task_id = str(uuid4())
-    with db.atomic():
-        if Task.select().where(Task.task_id == task_id).exists():
-            prev_task = Task.get(Task.task_id == task_id)
-            prev_task.status = "pending"
-            prev_task.prompt = prompt_request.prompt
-            prev_task.extra_args = json.dumps(
-                prompt_request.extra_args, ensure_ascii=False
-            )
-            prev_task.save()
-        else:
-            Task.create(
-                task_id=task_id,
-                prompt=prompt_request.prompt,
-                extra_args=json.dumps(prompt_request.extra_args, ensure_ascii=False),
-            )
-    return TaskResponse(task_id=task_id)
+    # Every task gets a concrete seed stored with it, so rerunning a task id
+    # reproduces the same image. "seeds" is the old name the worker read.
+    if "seeds" in prompt_request.extra_args:
+        prompt_request.extra_args.setdefault(
+            "seed", prompt_request.extra_args.pop("seeds")
+        )
+    prompt_request.extra_args.setdefault("seed", task_seed(task_id))
+    return {
+        "task_id": task_id,
+        "prompt": prompt_request.prompt,
+        "extra_args": json.dumps(prompt_request.extra_args, ensure_ascii=False),
+        "batch_key": batch_key(prompt_request.extra_args),
+        "content_hash": content_hash(
+            prompt_request.prompt, prompt_request.extra_args, MODEL_NAME
+        ),
+    }
+
+
+@app.post("/request", response_model=TaskResponse)
+async def create_task(prompt_request: PromptRequest):
+    row = prompt_request_to_row(prompt_request)
+    await backend.submit([row])
+    task_notifier.notify()
+    return TaskResponse(task_id=row["task_id"])
+
+
+async def iter_bulk_requests(request: Request):
+    # NDJSON bodies are parsed line by line as they arrive, anything else is
+    # treated as a JSON array of PromptRequest objects.
+    content_type = request.headers.get("content-type", "")
+    if "ndjson" in content_type or "jsonlines" in content_type:
+        buffer = b""
+        async for chunk in request.stream():
+            buffer += chunk
+            *lines, buffer = buffer.split(b"\n")
+            for line in lines:
+                if line.strip():
+                    yield json.loads(line)
+        if buffer.strip():
+            yield json.loads(buffer)
+    else:
+        items = json.loads(await request.body())
+        if not isinstance(items, list):
+            raise ValueError("Expected a JSON array of prompt requests")
+        for item in items:
+            yield item
+
+
+@app.post("/requests", response_model=BulkTaskResponse)
+async def create_tasks(request: Request):
+    task_ids = []
+    rows = []
+
+    async def flush():
+        if not rows:
+            return
+        await backend.submit(list(rows))
+        task_ids.extend(row["task_id"] for row in rows)
+        rows.clear()
+        task_notifier.notify()
+
+    try:
+        async for item in iter_bulk_requests(request):
+            rows.append(prompt_request_to_row(PromptRequest.model_validate(item)))
+            if len(rows) >= SUBMIT_CHUNK_SIZE:
+                await flush()
+    except (ValueError, ValidationError) as e:
+        # Chunks before the bad entry are already committed
+        raise HTTPException(
+            status_code=422,
+            detail=f"Invalid prompt request after {len(task_ids) + len(rows)} "
+            f"entries ({len(task_ids)} submitted): {e}",
+        )
+    await flush()
+    return BulkTaskResponse(task_ids=task_ids)
 
 
 @app.get("/reset/{task_id}")
-async def reset_task(task_id: str, db: SqliteDatabase = Depends(get_db)):
-    with db.atomic():
-        task = Task.get(Task.task_id == task_id)
-        task.status = "pending"
-        task.save()
+async def reset_task(task_id: str):
+    if not await backend.reset([task_id]):
+        raise HTTPException(status_code=404, detail="Task not found")
+    task_notifier.notify()
     return {"message": "Task reset successfully"}
 
 
+def task_to_request(task) -> TaskRequest:
+    return TaskRequest(
+        task_id=task.task_id,
+        prompt=task.prompt,
+        extra_args=json.loads(task.extra_args or "{}"),
+    )
+
+
 @app.get("/task", response_model=TaskRequest)
-async def get_task(db: SqliteDatabase = Depends(get_db)):
-    with db.atomic() as transaction:
-        try:
-            task = (
-                Task.select()
-                .where(Task.status == "pending")
-                .order_by(Task.created_at)
-                .get()
-            )
-            task.status = "processing"
-            task.save()
-            return TaskRequest(
-                task_id=task.task_id,
-                prompt=task.prompt,
-                extra_args=json.loads(task.extra_args or "{}"),
-            )
-        except Task.DoesNotExist:
-            raise HTTPException(status_code=404, detail="No pending tasks available")
-        except IntegrityError:
-            # Another process might have taken the task, rollback and try again
-            transaction.rollback()
-            raise HTTPException(
-                status_code=409,
-                detail="Task was taken by another process, please try again",
-            )
+async def get_task(
+    worker_id: Optional[str] = None,
+    lease: int = Query(LEASE_SECONDS, ge=1),
+    wait: float = Query(0, ge=0, le=MAX_LEASE_WAIT),
+):
+    try:
+        tasks = await lease_with_wait(1, worker_id, lease, wait)
+    except (IntegrityError, OperationalError):
+        # Another process might hold the write lock, try again
+        raise HTTPException(
+            status_code=409,
+            detail="Task was taken by another process, please try again",
+        )
+    if not tasks:
+        raise HTTPException(status_code=404, detail="No pending tasks available")
+    return task_to_request(tasks[0])
+
+
+@app.get("/tasks", response_model=list[TaskRequest])
+async def get_tasks(
+    limit: int = Query(16, ge=1, le=1024),
+    worker_id: Optional[str] = None,
+    lease: int = Query(LEASE_SECONDS, ge=1),
+    wait: float = Query(0, ge=0, le=MAX_LEASE_WAIT),
+    batch_key: Optional[str] = None,
+):
+    # Every returned task shares one batch key, the oldest pending task's
+    # unless a batch_key is requested
+    try:
+        tasks = await lease_with_wait(limit, worker_id, lease, wait, batch_key)
+    except (IntegrityError, OperationalError):
+        raise HTTPException(
+            status_code=409,
+            detail="Tasks were taken by another process, please try again",
+        )
+    return [task_to_request(task) for task in tasks]
+
+
+@app.post("/heartbeat", response_model=HeartbeatResponse)
+async def heartbeat(heartbeat_request: HeartbeatRequest):
+    seen_worker(heartbeat_request.worker_id)
+    held = await backend.extend_leases(
+        heartbeat_request.worker_id,
+        heartbeat_request.task_ids,
+        heartbeat_request.lease or LEASE_SECONDS,
+    )
+    return HeartbeatResponse(task_ids=held)
+
+
+def is_webp(header: bytes) -> bool:
+    return len(header) >= 12 and header[:4] == b"RIFF" and header[8:12] == b"WEBP"
 
 
 @app.post("/complete/{task_id}")
 async def complete_task(
-    task_id: str, image: UploadFile = File(...), db: SqliteDatabase = Depends(get_db)
+    task_id: str, image: UploadFile = File(...), timings: Optional[str] = Form(None)
 ):
-    with db.atomic():
-        task = Task.select().where(Task.task_id == task_id).first()
-        if not task:
-            raise HTTPException(status_code=404, detail="Task not found")
-
-        if task.status != "processing":
-            raise HTTPException(
-                status_code=400,
-                detail="Task is not in processing state: " + task.status,
-            )
+    # timings is a JSON encoded TaskTimings, sent as a form field next to the image
+    try:
+        timings = TaskTimings.model_validate_json(timings) if timings else None
+    except ValidationError as e:
+        raise HTTPException(status_code=422, detail=f"Invalid timings: {e}")
 
-        image.file.seek(0)
-        img = Image.open(image.file)
-        img.save(f"./images/{task_id}.webp", format="WEBP")
+    task = await backend.get(task_id)
+    if not task:
+        raise HTTPException(status_code=404, detail="Task not found")
 
-        task.status = "completed"
-        task.image_path = f"images/{task_id}.webp"
-        task.save()
+    if task.status != "processing":
+        raise HTTPException(
+            status_code=400,
+            detail="Task is not in processing state: " + task.status,
+        )
+
+    header = await image.read(12)
+    if REENCODE_QUALITY is None and not is_webp(header):
+        raise HTTPException(status_code=400, detail="Image is not a WEBP file")
+
+    # Named by content hash, so tasks linked to this image keep it even if
+    # this task id is later re-submitted with other arguments
+    t0 = perf_counter()
+    try:
+        image_path = await asyncio.to_thread(
+            image_store.save,
+            task.content_hash or task_id,
+            image.file,
+            REENCODE_QUALITY,
+        )
+    except Image.UnidentifiedImageError as e:
+        raise HTTPException(status_code=400, detail=f"Could not decode image: {e}")
+    metrics.UPLOAD_SECONDS.observe(perf_counter() - t0)
+    metrics.UPLOAD_BYTES.inc(image.size or 0)
+
+    if not await backend.complete(
+        task_id, image_path, timings.model_dump() if timings else None
+    ):
+        raise HTTPException(
+            status_code=409, detail="Task lease was lost before completion"
+        )
 
     return {"message": "Task completed successfully"}
 
 
-@app.get("/download/{task_id}")
-async def download_image(task_id: str, db: SqliteDatabase = Depends(get_db)):
-    with db.atomic():
-        task = Task.get_or_none(Task.task_id == task_id)
+@app.get("/stats", response_model=QueueStats)
+async def get_stats():
+    t0 = perf_counter()
+    stats = await backend.queue_stats()
+    return QueueStats(**stats, query_ms=(perf_counter() - t0) * 1000)
+
+
+@app.get("/report", response_model=CompletionReport)
+async def get_report(window: int = Query(3600, ge=1, le=7 * 24 * 3600)):
+    # Per-worker throughput and latency percentiles over the last `window` seconds
+    t0 = perf_counter()
+    report = await backend.completion_report(window)
+    return CompletionReport(**report, query_ms=(perf_counter() - t0) * 1000)
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    # Gauges are sampled at scrape time
+    for status, count in (await backend.task_counts()).items():
+        metrics.QUEUE_TASKS.set(count, status=status)
+    metrics.ACTIVE_WORKERS.set(active_workers())
+    return PlainTextResponse(
+        metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
+def is_not_modified(request: Request, response: Response) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        etags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return "*" in etags or response.headers["etag"] in etags
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since is not None:
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+            modified = parsedate_to_datetime(response.headers["last-modified"])
+        except (TypeError, ValueError):
+            return False
+        return modified <= since
+    return False
+
+
+def byte_range(request: Request, headers: dict, size: int) -> Optional[range]:
+    # The single "bytes=" range a request asks for, None to send everything.
+    # Like FileResponse, a stale If-Range gets the whole body. Multiple ranges
+    # do too, which HTTP allows.
+    range_header = request.headers.get("range")
+    if range_header is None:
+        return None
+    if_range = request.headers.get("if-range")
+    if if_range is not None and if_range not in (
+        headers["etag"],
+        headers["last-modified"],
+    ):
+        return None
+    unit, _, spec = range_header.partition("=")
+    first, sep, last = spec.strip().partition("-")
+    if unit.strip().lower() != "bytes" or "," in spec or not sep:
+        return None
+    try:
+        if first:
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+        else:
+            # "bytes=-N", the last N bytes
+            start, end = max(size - int(last), 0), size - 1
+    except ValueError:
+        return None
+    if start > end or start >= size:
+        raise HTTPException(
+            status_code=416,
+            detail="Range not satisfiable",
+            headers={"content-range": f"bytes */{size}"},
+        )
+    return range(start, end + 1)
+
+
+# HEAD lets the downloader compare sizes with files it already has
+@app.api_route("/download/{task_id}", methods=["GET", "HEAD"])
+async def download_image(task_id: str, request: Request):
+    task = await backend.get(task_id)
     if not task or task.status != "completed":
         raise HTTPException(
             status_code=404, detail="Image not found or task not completed"
@@ -156,10 +610,107 @@ async def download_image(task_id: str, db: SqliteDatabase = Depends(get_db)):
     if not task.image_path:
         raise HTTPException(status_code=404, detail="Image data not found")
 
-    with open(task.image_path, "rb") as f:
-        image_data = f.read()
+    path = image_store.local_path(task.image_path)
+    if path is not None:
+        try:
+            stat_result = await asyncio.to_thread(os.stat, path)
+        except FileNotFoundError:
+            raise HTTPException(status_code=404, detail="Image file not found")
+        # FileResponse streams from disk (sendfile where the server supports
+        # it) and handles ETag, Last-Modified and Range requests.
+        response = FileResponse(path, media_type="image/webp", stat_result=stat_result)
+    else:
+        image = await asyncio.to_thread(image_store.read, task.image_path)
+        if image is None:
+            raise HTTPException(status_code=404, detail="Image file not found")
+        data, mtime = image
+        # A slice of the mapped pack, packed images never change in place so
+        # the location makes a strong ETag
+        etag = hashlib.md5(task.image_path.encode("utf-8")).hexdigest()
+        headers = {
+            "etag": f'"{etag}"',
+            "last-modified": formatdate(mtime, usegmt=True),
+            "accept-ranges": "bytes",
+        }
+        response = Response(data, media_type="image/webp", headers=headers)
+    if is_not_modified(request, response):
+        return Response(
+            status_code=304,
+            headers={
+                "etag": response.headers["etag"],
+                "last-modified": response.headers["last-modified"],
+            },
+        )
+    if path is None:
+        # FileResponse answers Range requests itself, slices of packs need it here
+        part = byte_range(request, headers, len(data))
+        if part is not None:
+            return Response(
+                data[part.start : part.stop],
+                status_code=206,
+                media_type="image/webp",
+                headers={
+                    **headers,
+                    "content-range": f"bytes {part.start}-{part.stop - 1}/{len(data)}",
+                },
+            )
+    return response
+
+
+ARCHIVE_PAGE_SIZE = 1000
+
+
+def tar_entry(name: str, data: bytes, mtime: float) -> bytes:
+    return tar_header(name, len(data), mtime) + data + tar_padding(len(data))
+
 
-    return Response(content=image_data, media_type="image/webp")
+async def iter_archive(task_ids: Optional[list[str]] = None, prefix: str = None):
+    # Builds the tar one image at a time while the response is being sent,
+    # paging through the task ids so neither the archive nor the id list is
+    # held in memory.
+    if task_ids is not None:
+        pages = (
+            task_ids[i : i + ARCHIVE_PAGE_SIZE]
+            for i in range(0, len(task_ids), ARCHIVE_PAGE_SIZE)
+        )
+    after = None
+    while True:
+        if task_ids is not None:
+            page = next(pages, None)
+            if page is None:
+                break
+            images = await backend.completed_images(task_ids=page)
+        else:
+            images = await backend.completed_images(
+                prefix=prefix, after=after, limit=ARCHIVE_PAGE_SIZE
+            )
+            if not images:
+                break
+            after = images[-1][0]
+        for task_id, image_path in images:
+            image = await asyncio.to_thread(image_store.read, image_path)
+            if image is None:
+                continue
+            yield tar_entry(f"{task_id}.webp", *image)
+    yield b"\0" * (tarfile.BLOCKSIZE * 2)
+
+
+@app.get("/archive")
+async def download_archive(prefix: str = Query(..., min_length=1)):
+    return StreamingResponse(
+        iter_archive(prefix=prefix),
+        media_type="application/x-tar",
+        headers={"content-disposition": 'attachment; filename="images.tar"'},
+    )
+
+
+@app.post("/archive")
+async def download_archive_by_ids(archive_request: ArchiveRequest):
+    return StreamingResponse(
+        iter_archive(task_ids=archive_request.task_ids),
+        media_type="application/x-tar",
+        headers={"content-disposition": 'attachment; filename="images.tar"'},
+    )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,249 @@
+import io
+import os
+import mmap
+import time
+import shutil
+import hashlib
+import tarfile
+import threading
+from uuid import uuid4
+from typing import Optional
+
+from PIL import Image
+
+# Packed images are stored as "<pack path>@<offset>:<size>", the offset and
+# size of the image bytes inside the pack, the tar header sits right before
+PACK_SUFFIX = ".tar"
+
+
+def pack_location(location: str) -> Optional[tuple[str, int, int]]:
+    # (pack path, offset, size) of a packed image, None for a plain file path
+    path, sep, span = location.rpartition("@")
+    if not sep or not path.endswith(PACK_SUFFIX):
+        return None
+    offset, _, size = span.partition(":")
+    return path, int(offset), int(size)
+
+
+def tar_header(name: str, size: int, mtime: float) -> bytes:
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mtime = int(mtime)
+    info.mode = 0o644
+    return info.tobuf(format=tarfile.GNU_FORMAT)
+
+
+def tar_padding(size: int) -> bytes:
+    return b"\0" * (-size % tarfile.BLOCKSIZE)
+
+
+def webp_bytes(file, reencode_quality: Optional[int] = None) -> bytes:
+    file.seek(0)
+    if reencode_quality is None:
+        return file.read()
+    buffer = io.BytesIO()
+    Image.open(file).save(buffer, format="WEBP", quality=reencode_quality)
+    return buffer.getvalue()
+
+
+def index_names(path: str) -> dict[int, str]:
+    # {offset: name} of the images in a pack as listed by its index
+    names = {}
+    if not os.path.exists(f"{path}.idx"):
+        return names
+    with open(f"{path}.idx", "r", encoding="utf-8") as f:
+        for line in f:
+            name, offset, _ = line.rstrip("\n").rsplit("\t", 2)
+            names[int(offset)] = name
+    return names
+
+
+def tar_names(path: str) -> dict[int, str]:
+    # The same read from the pack itself, tarfile resolves GNU long names
+    with tarfile.open(path, "r:") as pack:
+        return {member.offset_data: member.name for member in pack}
+
+
+class ImageStore:
+    # Where completed images live. save() returns the location that goes into
+    # image_path. Every store reads both plain files and packed images, so rows
+    # written under another IMAGE_STORE setting stay readable.
+    def __init__(self, root="images"):
+        self.root = root
+        # pack path -> (mmap, mtime), remapped when a pack grew past the map
+        self.maps = {}
+        self.maps_lock = threading.Lock()
+        # pack path -> {offset: member name}, reread when a pack grew
+        self.names = {}
+
+    def start(self):
+        pass
+
+    def stop(self):
+        with self.maps_lock:
+            for mapped, _ in self.maps.values():
+                try:
+                    mapped.close()
+                except BufferError:
+                    # A response still holds a slice, let it go with the GC
+                    pass
+            self.maps = {}
+            self.names = {}
+
+    def save(self, name: str, file, reencode_quality: Optional[int] = None) -> str:
+        raise NotImplementedError
+
+    def owns(self, location: str) -> bool:
+        # Whether the location already has the layout this store writes
+        raise NotImplementedError
+
+    def local_path(self, location: str) -> Optional[str]:
+        # The file to serve directly, None for packed images
+        return None if pack_location(location) else location
+
+    def key(self, location: str) -> str:
+        # The name an image was saved under, content hash or task id
+        packed = pack_location(location)
+        if packed is None:
+            return os.path.basename(location).removesuffix(".webp")
+        path, offset, _ = packed
+        with self.maps_lock:
+            names = self.names.get(path)
+            if names is None or offset not in names:
+                names = self.names[path] = index_names(path)
+            if offset not in names:
+                # No index, or one cut short by a crash
+                names.update(tar_names(path))
+        # The tar header right before the image holds at most 100 characters
+        # of the name, longer ones sit in a GNU long name entry before it
+        return names[offset].removesuffix(".webp")
+
+    def mapping(self, path: str, end: int):
+        with self.maps_lock:
+            entry = self.maps.get(path)
+            if entry is None or len(entry[0]) < end:
+                with open(path, "rb") as f:
+                    entry = (
+                        mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ),
+                        os.fstat(f.fileno()).st_mtime,
+                    )
+                self.maps[path] = entry
+            return entry
+
+    def read(self, location: str) -> Optional[tuple[bytes | memoryview, float]]:
+        # (image bytes, mtime), packed images are slices of the mapped pack
+        packed = pack_location(location)
+        try:
+            if packed is None:
+                with open(location, "rb") as f:
+                    return f.read(), os.fstat(f.fileno()).st_mtime
+            path, offset, size = packed
+            mapped, mtime = self.mapping(path, offset + size)
+        except FileNotFoundError:
+            return None
+        return memoryview(mapped)[offset : offset + size], mtime
+
+
+class FileStore(ImageStore):
+    # One file per image, fanned out over `fanout` levels of 256 directories
+    # by the hash of its name: images/3f/a2/<name>.webp
+    def __init__(self, root="images", fanout=2):
+        super().__init__(root)
+        self.fanout = fanout
+        self.made_dirs = set()
+
+    def path(self, name: str) -> str:
+        digest = hashlib.sha256(name.encode("utf-8")).hexdigest()
+        parts = [digest[2 * i : 2 * i + 2] for i in range(self.fanout)]
+        return "/".join([self.root, *parts, f"{name}.webp"])
+
+    def owns(self, location):
+        return pack_location(location) is None and location == self.path(
+            self.key(location)
+        )
+
+    def save(self, name, file, reencode_quality=None):
+        path = self.path(name)
+        directory = os.path.dirname(path)
+        if directory not in self.made_dirs:
+            os.makedirs(directory, exist_ok=True)
+            self.made_dirs.add(directory)
+        # Write to a temp file next to the target and rename, so a crash or a
+        # concurrent download never sees a partial image.
+        tmp_path = f"{path}.{uuid4().hex}.tmp"
+        try:
+            file.seek(0)
+            if reencode_quality is None:
+                with open(tmp_path, "wb") as f:
+                    shutil.copyfileobj(file, f, 1024 * 1024)
+            else:
+                Image.open(file).save(tmp_path, format="WEBP", quality=reencode_quality)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return path
+
+
+class PackedStore(ImageStore):
+    # Appends images to tar files of up to `pack_size` bytes under root, one
+    # open pack per process so several server processes never share one.
+    # Members are named <name>.webp, a finished pack is a valid tar that
+    # WebDataset and tar -x read as is. Next to each pack, <pack>.idx lists
+    # "name\toffset\tsize" per member, the image_path rows point into the pack
+    # directly so the server itself never reads it.
+    def __init__(self, root="images/packs", pack_size=1 << 30):
+        super().__init__(root)
+        self.pack_size = pack_size
+        self.lock = threading.Lock()
+        self.pack = None
+        self.index = None
+        self.pack_path = None
+        self.written = 0
+
+    def owns(self, location):
+        packed = pack_location(location)
+        return packed is not None and os.path.dirname(packed[0]) == self.root
+
+    def open_pack(self):
+        os.makedirs(self.root, exist_ok=True)
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid4().hex[:8]}{PACK_SUFFIX}"
+        self.pack_path = f"{self.root}/{name}"
+        self.pack = open(self.pack_path, "xb")
+        self.index = open(f"{self.pack_path}.idx", "x", encoding="utf-8")
+        self.written = 0
+
+    def close_pack(self):
+        if self.pack is None:
+            return
+        # End-of-archive marker, readers also accept a pack cut short by a crash
+        self.pack.write(b"\0" * (tarfile.BLOCKSIZE * 2))
+        self.pack.close()
+        self.index.close()
+        self.pack = self.index = None
+
+    def stop(self):
+        with self.lock:
+            self.close_pack()
+        super().stop()
+
+    def save(self, name, file, reencode_quality=None):
+        data = webp_bytes(file, reencode_quality)
+        member = f"{name}.webp"
+        header = tar_header(member, len(data), time.time())
+        entry_size = len(header) + len(data) + (-len(data) % tarfile.BLOCKSIZE)
+        with self.lock:
+            if self.pack is None or (
+                self.written and self.written + entry_size > self.pack_size
+            ):
+                self.close_pack()
+                self.open_pack()
+            offset = self.written + len(header)
+            self.pack.write(header)
+            self.pack.write(data)
+            self.pack.write(tar_padding(len(data)))
+            self.pack.flush()
+            self.index.write(f"{member}\t{offset}\t{len(data)}\n")
+            self.index.flush()
+            self.written += entry_size
+            return f"{self.pack_path}@{offset}:{len(data)}"
@@ -0,0 +1,67 @@
+import json
+import asyncio
+
+import pytest
+
+from dig_server.db import batch_key, content_hash
+from dig_server.backend import SqliteBackend, ShardedSqliteBackend
+from dig_server.memqueue import MemoryBackend
+
+
+def make_backend(name, path):
+    if name == "sqlite":
+        return SqliteBackend(str(path / "tasks.db"), readers=1)
+    if name == "sharded":
+        return ShardedSqliteBackend(str(path / "tasks.db"), shards=2, readers=1)
+    return MemoryBackend(str(path / "queue"))
+
+
+def row(task_id, prompt="cat", seed=1):
+    extra_args = {"seed": seed}
+    return {
+        "task_id": task_id,
+        "prompt": prompt,
+        "extra_args": json.dumps(extra_args),
+        "batch_key": batch_key(extra_args),
+        "content_hash": content_hash(prompt, extra_args),
+    }
+
+
+@pytest.fixture(params=["sqlite", "sharded", "memory"])
+def run(request, tmp_path):
+    # Runs a coroutine function against a started backend
+    backend = make_backend(request.param, tmp_path)
+
+    async def main(fn):
+        backend.start()
+        try:
+            return await fn(backend)
+        finally:
+            backend.stop()
+
+    return lambda fn: asyncio.run(main(fn))
+
+
+def test_reset_linked_task_counts_its_own_completion(run):
+    async def scenario(backend):
+        await backend.submit([row("a")])
+        await backend.lease(1, "w1", 60)
+        await backend.complete("a", "a.webp")
+        await backend.submit([row("b")])
+        assert (await backend.get("b")).linked_from == "a"
+
+        await backend.reset(["b"])
+        assert [task.task_id for task in await backend.lease(1, "w2", 60)] == ["b"]
+        await backend.complete("b", "b.webp")
+        task = await backend.get("b")
+        assert task.linked_from is None
+        assert task.image_path == "b.webp"
+
+        stats = await backend.queue_stats()
+        report = await backend.completion_report(3600)
+        return stats, report
+
+    stats, report = run(scenario)
+    assert stats["throughput"]["60s"] == pytest.approx(2 / 60)
+    assert report["completed"] == 2
+    assert set(report["workers"]) == {"w1", "w2"}
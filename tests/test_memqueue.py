@@ -0,0 +1,60 @@
+import random
+
+from dig_server.memqueue import QueueState, load_snapshot, write_snapshot, TASK_ID
+
+
+def random_records(rng, state, count, now):
+    # Submits, leases, completions and resets over a few task ids and hashes,
+    # so tasks get linked, reset and resubmitted with other prompts
+    for _ in range(count):
+        now += 1
+        op = rng.random()
+        if op < 0.4:
+            rows = []
+            for _ in range(rng.randint(1, 4)):
+                prompt = f"p{rng.randrange(5)}"
+                rows.append(
+                    {
+                        "task_id": f"t{rng.randrange(60)}",
+                        "prompt": prompt,
+                        "extra_args": "{}",
+                        "batch_key": "",
+                        "content_hash": prompt,
+                    }
+                )
+            yield ["submit", rows, now]
+        elif op < 0.65:
+            tasks = state.take_pending(rng.randint(1, 3))
+            if tasks:
+                yield ["lease", [task[TASK_ID] for task in tasks], "w", now + 60, now]
+        elif op < 0.9:
+            processing = [
+                task_id
+                for task_id, task in state.tasks.items()
+                if state.can_complete(task_id)
+            ]
+            if processing:
+                task_id = rng.choice(sorted(processing))
+                yield ["complete", task_id, f"{task_id}-{now}.webp", now, None]
+        elif state.tasks:
+            yield ["reset", [rng.choice(sorted(state.tasks))]]
+
+
+def test_snapshot_restores_link_sources(tmp_path):
+    rng = random.Random(0)
+    live = QueueState()
+    for record in random_records(rng, live, 300, 0):
+        live.apply(record)
+    write_snapshot(str(tmp_path), live, 1)
+    restored, _ = load_snapshot(str(tmp_path))
+
+    # Carry on with the same records on both, the restored state has to make
+    # the same choices
+    for record in random_records(rng, live, 300, 1000):
+        if record[0] == "lease":
+            assert [
+                task[TASK_ID] for task in restored.take_pending(len(record[1]))
+            ] == (record[1])
+        live.apply(record)
+        restored.apply(record)
+    assert restored.by_seq == live.by_seq
@@ -0,0 +1,34 @@
+import pytest
+from pydantic import ValidationError
+
+from dig_server.server import PromptRequest
+
+
+@pytest.mark.parametrize(
+    "extra_args",
+    [
+        {"width": 1000},
+        {"height": "abc"},
+        {"width": 0},
+        {"height": True},
+        {"guidance_scale": "high"},
+    ],
+)
+def test_rejects_bad_generation_args(extra_args):
+    with pytest.raises(ValidationError):
+        PromptRequest(prompt="cat", extra_args=extra_args)
+
+
+def test_accepts_generation_args():
+    extra_args = {"width": 832, "height": 1216, "guidance_scale": 5, "steps": 24}
+    assert PromptRequest(prompt="cat", extra_args=extra_args).extra_args == extra_args
+
+
+@pytest.mark.parametrize("name", ["seed", "seeds"])
+def test_seed_must_be_an_integer(name):
+    with pytest.raises(ValidationError):
+        PromptRequest(prompt="cat", extra_args={name: "abc"})
+    with pytest.raises(ValidationError):
+        PromptRequest(prompt="cat", extra_args={name: 1.5})
+    request = PromptRequest(prompt="cat", extra_args={name: "42"})
+    assert request.extra_args[name] == 42
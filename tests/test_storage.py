@@ -0,0 +1,31 @@
+import io
+import os
+
+import pytest
+
+from dig_server.storage import FileStore, PackedStore
+
+
+@pytest.mark.parametrize("store_class", [FileStore, PackedStore])
+def test_key_of_long_names(tmp_path, store_class):
+    store = store_class(str(tmp_path / "images"))
+    names = ["short", "a" * 100, "task-" + "0123456789" * 20]
+    try:
+        locations = [store.save(name, io.BytesIO(b"image")) for name in names]
+        assert [store.key(location) for location in locations] == names
+    finally:
+        store.stop()
+
+
+def test_key_without_pack_index(tmp_path):
+    store = PackedStore(str(tmp_path / "packs"))
+    names = ["short", "task-" + "0123456789" * 20]
+    try:
+        locations = [store.save(name, io.BytesIO(b"image")) for name in names]
+    finally:
+        store.stop()
+    os.remove(f"{store.pack_path}.idx")
+    reader = PackedStore(str(tmp_path / "packs"))
+    assert [reader.key(location) for location in locations] == names
+    assert bytes(reader.read(locations[1])[0]) == b"image"
+    reader.stop()